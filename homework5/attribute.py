@@ -1,5 +1,6 @@
 #!/usr/bin/python
 
+import functools
 import re
 import string
 import unittest
@@ -13,6 +14,73 @@ def isBasicRegex(test):
 
     return False
 
+def getPrefix(test):
+    "Returns the prefix of a basic regex that only has a single trailing '*'."
+    if type(test) is str and test.endswith('*') and test.count('*') == 1:
+        return test[:-1]
+    return None
+
+# Range criteria, for int and float attributes: "<10", "<=10", ">10", ">=10",
+# and "5..20" (both ends included; "5.." and "..20" leave one end open).
+_rangePattern = re.compile(r'\s*(?:(?P<op><=|>=|<|>)\s*(?P<bound>\S+)|'
+                           r'(?P<low>\S*?)\s*\.\.\s*(?P<high>\S*))\s*\Z')
+rangeTypes = (int, float)
+
+def getRange(type_, test):
+    """Returns the (low, high, includeLow, includeHigh) bounds of a range criteria
+over type_ (None for an open end), or None if test isn't one."""
+    if type_ not in rangeTypes or type(test) is not str:
+        return None
+    return _parseRange(type_, test)
+
+@functools.lru_cache(maxsize = 256)
+def _parseRange(type_, test):
+    match = _rangePattern.match(test)
+    if match is None:
+        return None
+    try:
+        op = match.group('op')
+        if op is not None:
+            bound = type_(match.group('bound'))
+            if op[0] == '<':
+                return (None, bound, True, op == '<=')
+            return (bound, None, op == '>=', True)
+
+        (low, high) = (match.group('low'), match.group('high'))
+        if len(low) == 0 and len(high) == 0:
+            return None
+        return (type_(low) if len(low) > 0 else None,
+                type_(high) if len(high) > 0 else None, True, True)
+    except ValueError:
+        return None
+
+def checkCriteria(type_, test, compares = False):
+    """Raises ValueError if test, matched against a type_, is a comparison or
+range that can't work: one on something other than a number, or one whose
+bounds aren't type_s. compares says it was written key<"value" rather than
+key="<value", which on a str is just text to match."""
+    if type(test) is not str:
+        return
+    if type_ not in rangeTypes:
+        if compares:
+            raise ValueError("comparisons only work on numbers")
+        return
+    if (compares or _rangePattern.match(test) is not None) and getRange(type_, test) is None:
+        raise ValueError("that isn't a range of {0}s".format(type_.__name__))
+
+def inRange(value, bounds):
+    "Returns whether value is within the bounds getRange returned."
+    (low, high, includeLow, includeHigh) = bounds
+    if low is not None and (value < low or (value == low and not includeLow)):
+        return False
+    if high is not None and (value > high or (value == high and not includeHigh)):
+        return False
+    return True
+
+# How many compiled criteria strToRegex holds on to.
+REGEX_CACHE_SIZE = 256
+
+@functools.lru_cache(maxsize = REGEX_CACHE_SIZE)
 def strToRegex(toRegex):
     handleChars = ['\\', '?', '^', '$', '(', ')', '[', ']', '.', '+']
 
@@ -27,12 +95,140 @@ def strToRegex(toRegex):
     except:
         return None
 
+def regexCacheInfo():
+    "Returns the (hits, misses, maxsize, currsize) of the strToRegex cache."
+    return strToRegex.cache_info()
+
+def clearRegexCache():
+    strToRegex.cache_clear()
+
+#
+# Value helpers:
+# The Attribute class below and Records (which only keep bare values around,
+# and leave the types to their Schema) share these, so a value of some type_
+# gets cast, printed and matched the same way no matter where it lives. A value
+# of some other type (usually a str, from a file or a request) gets cast by
+# calling its type.
+#
+def castValue(type_, valueTo):
+    "Casts valueTo to type_. Returns (success, value); value is None on failure."
+    if valueTo is None:
+        return (True, None)
+    elif type(valueTo) is not type_:
+        try:
+            return (True, type_(valueTo))
+        except:
+            return (False, None)
+    return (True, valueTo)
+
+def convertColumn(type_, column):
+    """Casts every value in column (a list, say all the quantities in a file) to
+type_ in one go. Returns (values, failures), where failures are the (row, value)
+of values that couldn't be cast; those come back as None in values."""
+    try:
+        return ([v if v is None or type(v) is type_ else type_(v) for v in column], [])
+    except (ValueError, TypeError, ArithmeticError):
+        pass
+
+    # Something in there is bad: go over it again a value at a time to find what.
+    values = []
+    failures = []
+    for (row, v) in enumerate(column):
+        (success, value) = castValue(type_, v)
+        values.append(value)
+        if not success:
+            failures.append((row, v))
+    return (values, failures)
+
+def valueAsStr(type_, value):
+    "Return value (of type type_) as a string"
+    return value if type_ is str or value is None else str(value)
+
+def _matchesCriteriaRegex(type_, value, criteriaStr, reg = None):
+    assert criteriaStr is not None
+    assert value is not None
+
+    if reg is None:
+        reg = strToRegex(criteriaStr)
+
+    if reg is None:
+        raise ValueError("Couldn't parse input criteria")
+
+    return reg.match(valueAsStr(type_, value)) is not None
+
+def _matchesCriteriaType(type_, value, criteriaStr):
+    assert criteriaStr is not None
+    assert value is not None
+
+    try:
+        criteriaType = type_(criteriaStr)
+    except:
+        return False
+
+    return value == criteriaType
+
+def valueMatchesCriteria(type_, value, criteriaStr, forceRaw = False, reg = None):
+    """Checks if value (of type type_) matches the given criteria. reg may be the
+already compiled strToRegex(criteriaStr), for callers matching many values."""
+    if criteriaStr is None:
+        return True
+
+    if value is None:
+        return False
+
+    if not forceRaw:
+        bounds = getRange(type_, criteriaStr)
+        if bounds is not None:
+            return inRange(value, bounds)
+
+    if not forceRaw and isBasicRegex(criteriaStr):
+        return _matchesCriteriaRegex(type_, value, criteriaStr, reg)
+    else:
+        return _matchesCriteriaType(type_, value, criteriaStr)
+
+def _never(value):
+    return False
+
+def compileCriteria(type_, criteriaStr):
+    """Does the per-criteria work of valueMatchesCriteria once, for matching lots
+of values against criteriaStr. Returns (value, None) if the criteria is an exact
+match for value, or else (None, test), where test(value) says whether a value
+(of type type_, and not None) matches."""
+    bounds = getRange(type_, criteriaStr)
+    if bounds is not None:
+        (low, high, includeLow, includeHigh) = bounds
+        if low is None:
+            return (None, (lambda v: v <= high) if includeHigh else (lambda v: v < high))
+        if high is None:
+            return (None, (lambda v: v >= low) if includeLow else (lambda v: v > low))
+        return (None, lambda v: inRange(v, bounds))
+
+    if isBasicRegex(criteriaStr):
+        prefix = getPrefix(criteriaStr)
+        if prefix is not None and type_ is str:
+            return (None, lambda v: v.startswith(prefix))
+        reg = strToRegex(criteriaStr)
+        if reg is None:
+            # Only complain once there's a value to match, like valueMatchesCriteria.
+            return (None, lambda v: _matchesCriteriaRegex(type_, v, criteriaStr))
+        match = reg.match
+        if type_ is str:
+            return (None, lambda v: match(v) is not None)
+        return (None, lambda v: match(valueAsStr(type_, v)) is not None)
+
+    try:
+        return (type_(criteriaStr), None)
+    except:
+        return (None, _never)
+
 # 
 # Attribute class:
 # Used so that attributes can be generic/very easily added/removed. 
 # This class takes care of type casting, type matching, etc.
 #
 class Attribute:
+    __slots__ = ('type_', 'value', 'multi', 'required')
+
     def __init__(self, attr = None):
             self.type_ = str
             self.value = None
@@ -60,13 +256,22 @@ class Attribute:
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def copy(self):
+        "Returns a new Attribute with the same type, value and flags."
+        result = Attribute.__new__(type(self))
+        result.type_ = self.type_
+        result.value = self.value
+        result.multi = self.multi
+        result.required = self.required
+        return result
+
     def isNull(self):
         "Return if this has a value."
         return self.value is None
 
     def asStr(self):
         "Return value as a string"
-        return self.value if self.type_ is str or self.value is None else str(self.value)
+        return valueAsStr(self.type_, self.value)
 
     def asNatural(self):
         "Return value as the type it's supposed to be"
@@ -89,41 +294,8 @@ class Attribute:
 
     def setValue(self, valueTo):
         "Set the value of the Attribute, with necessary casting."
-        if valueTo is None:
-            self.value = None
-        elif type(valueTo) is not self.type_:
-            try:
-                self.value = self.type_(valueTo)
-                return True
-            except:
-                self.value = None
-                return False
-        else:
-            self.value = valueTo
-        return True
-
-    def _matchesCriteriaRegex(self, criteriaStr):
-        assert criteriaStr is not None
-        assert self.value is not None
-        
-        reg = strToRegex(criteriaStr)
-
-        if reg is None:
-            raise ValueError("Couldn't parse input criteria")
-
-        return reg.match(self.asStr()) is not None
-
-
-    def _matchesCriteriaType(self, criteriaStr):
-        assert criteriaStr is not None
-        assert self.value is not None
-
-        try:
-            criteriaType = self.type_(criteriaStr)
-        except:
-            return False
-
-        return self.asNatural() == criteriaType
+        (success, self.value) = castValue(self.type_, valueTo)
+        return success
 
     def multipleAllowed(self):
         return self.multi
@@ -131,18 +303,10 @@ class Attribute:
     def setMultipleAllowed(self, multi):
         self.multi = bool(multi)
 
-    def matchesCriteria(self, criteriaStr, forceRaw = False):
-        "Checks if this matches the given criteria."
-        if criteriaStr is None:
-            return True
-
-        if self.value is None:
-            return False
-
-        if not forceRaw and isBasicRegex(criteriaStr):
-            return self._matchesCriteriaRegex(criteriaStr)
-        else:
-            return self._matchesCriteriaType(criteriaStr)
+    def matchesCriteria(self, criteriaStr, forceRaw = False, reg = None):
+        """Checks if this matches the given criteria. reg may be the already
+compiled strToRegex(criteriaStr), for callers matching many attributes."""
+        return valueMatchesCriteria(self.type_, self.value, criteriaStr, forceRaw, reg)
 
 class AttributeTests(unittest.TestCase):
     def test_standalone(self):
@@ -155,6 +319,34 @@ class AttributeTests(unittest.TestCase):
         self.assertTrue(isBasicRegex("*3"))
         self.assertTrue(isBasicRegex("*"))
 
+        # testing getPrefix
+        self.assertEqual(getPrefix("3*"), "3")
+        self.assertEqual(getPrefix("*"), "")
+        self.assertIsNone(getPrefix("30"))
+        self.assertIsNone(getPrefix(30))
+        self.assertIsNone(getPrefix("*3"))
+        self.assertIsNone(getPrefix("3**"))
+        self.assertIsNone(getPrefix("*3*"))
+
+        # testing getRange
+        self.assertEqual(getRange(int, "<10"), (None, 10, True, False))
+        self.assertEqual(getRange(int, "<= 10"), (None, 10, True, True))
+        self.assertEqual(getRange(int, ">10"), (10, None, False, True))
+        self.assertEqual(getRange(int, ">=10"), (10, None, True, True))
+        self.assertEqual(getRange(int, "5..20"), (5, 20, True, True))
+        self.assertEqual(getRange(int, "5.."), (5, None, True, True))
+        self.assertEqual(getRange(int, "..20"), (None, 20, True, True))
+        self.assertEqual(getRange(float, "1.5..2.5"), (1.5, 2.5, True, True))
+        self.assertEqual(getRange(float, "-1e3..-2"), (-1000.0, -2.0, True, True))
+        self.assertIsNone(getRange(str, "<10"))
+        self.assertIsNone(getRange(int, "10"))
+        self.assertIsNone(getRange(int, ".."))
+        self.assertIsNone(getRange(int, "<ten"))
+        self.assertIsNone(getRange(int, "1..2..3"))
+        self.assertTrue(inRange(10, getRange(int, "5..10")))
+        self.assertFalse(inRange(10, getRange(int, "<10")))
+        self.assertFalse(inRange(4, getRange(int, "5..")))
+
         # testing the building regex functions
         reg = strToRegex("3*")
         self.assertIsNotNone(reg)
@@ -175,6 +367,49 @@ class AttributeTests(unittest.TestCase):
         self.assertIsNone(reg.match("3"))
         self.assertIsNone(reg.match(""))
 
+    def test_ranges(self):
+        self.assertTrue(valueMatchesCriteria(int, 3, "<10"))
+        self.assertFalse(valueMatchesCriteria(int, 10, "<10"))
+        self.assertTrue(valueMatchesCriteria(int, 10, "10..20"))
+        self.assertFalse(valueMatchesCriteria(int, 21, "10..20"))
+        self.assertTrue(valueMatchesCriteria(float, 0.5, ">0"))
+        self.assertFalse(valueMatchesCriteria(int, None, ">0"))
+        # Only numbers have ranges; for anything else it's just a string.
+        self.assertFalse(valueMatchesCriteria(str, "3", "<10"))
+        self.assertTrue(valueMatchesCriteria(str, "<10", "<10"))
+        self.assertFalse(valueMatchesCriteria(int, 3, "<10", forceRaw = True))
+
+        # Comparisons and ranges that can't work get turned away up front.
+        for (type_, criteria, compares) in [(int, "<10", True), (float, "1.5..2", False),
+                                            (int, "10", False), (str, "<10", False),
+                                            (str, "1..2", False), (str, "*", False)]:
+            checkCriteria(type_, criteria, compares)
+        for (type_, criteria, compares) in [(str, "<10", True), (int, "<5.5", True),
+                                            (int, "<5.5", False), (int, "1..x", False),
+                                            (int, "<5 6", True), (float, "<lots", False)]:
+            self.assertRaises(ValueError, checkCriteria, type_, criteria, compares)
+
+    def test_compileCriteria(self):
+        for (type_, criteria) in [(int, "<10"), (int, "<=10"), (int, ">10"), (int, ">=10"),
+                                  (int, "5..10"), (float, "..2.5"), (int, "1*"),
+                                  (int, "*0"), (str, "1*"), (str, "*1*"), (str, "10"),
+                                  (str, "<10"), (int, "10"), (int, "lol")]:
+            (exact, test) = compileCriteria(type_, criteria)
+            for v in [type_(x) for x in ["0", "1", "5", "10", "11", "100"]]:
+                matched = v == exact if test is None else test(v)
+                self.assertEqual(matched, valueMatchesCriteria(type_, v, criteria),
+                                 (type_, criteria, v))
+        self.assertEqual(compileCriteria(int, "010"), (10, None))
+
+    def test_convertColumn(self):
+        self.assertEqual(convertColumn(int, ["1", None, 2, " 3 "]), ([1, None, 2, 3], []))
+        self.assertEqual(convertColumn(int, ["1", "lots", "2.5", "4"]),
+                         ([1, None, None, 4], [(1, "lots"), (2, "2.5")]))
+        self.assertEqual(convertColumn(float, ["1", "1e3", "x"]),
+                         ([1.0, 1000.0, None], [(2, "x")]))
+        self.assertEqual(convertColumn(str, ["a", 3]), (["a", "3"], []))
+        self.assertEqual(convertColumn(int, []), ([], []))
+
     def test_constructor(self):
         # make sure constructors work properly
         at1 = Attribute()
@@ -232,6 +467,33 @@ class AttributeTests(unittest.TestCase):
         self.assertFalse(at1.matchesCriteria(""))
         self.assertTrue(at1.matchesCriteria(None))
 
+        # Passing in the compiled criteria gives the same answers.
+        self.assertTrue(at1.matchesCriteria("3*", reg = strToRegex("3*")))
+        self.assertFalse(at1.matchesCriteria("*3", reg = strToRegex("*3")))
+
+    def test_regexCache(self):
+        clearRegexCache()
+        info = regexCacheInfo()
+        self.assertEqual(info.hits, 0)
+        self.assertEqual(info.misses, 0)
+        self.assertEqual(info.maxsize, REGEX_CACHE_SIZE)
+
+        at1 = Attribute()
+        at1.setValue("hello")
+        for i in range(10):
+            self.assertTrue(at1.matchesCriteria("he*"))
+        self.assertFalse(at1.matchesCriteria("*x"))
+
+        info = regexCacheInfo()
+        self.assertEqual(info.misses, 2)
+        self.assertEqual(info.hits, 9)
+        self.assertEqual(info.currsize, 2)
+        self.assertIs(strToRegex("he*"), strToRegex("he*"))
+
+        for i in range(REGEX_CACHE_SIZE + 10):
+            strToRegex(str(i) + "*")
+        self.assertEqual(regexCacheInfo().currsize, REGEX_CACHE_SIZE)
+
 
 # If we're main, unit tests.
 if __name__ == '__main__':
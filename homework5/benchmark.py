@@ -0,0 +1,348 @@
+#!/usr/bin/python
+
+import argparse
+import columns
+import copy
+import inventory
+import locks
+import os
+import parser
+import protocol
+import random
+import shards
+import shutil
+import store
+import sys
+import tempfile
+import threading
+import time
+
+#
+# Benchmarks:
+# Each benchmark takes a record count and prints a short report. They build
+# their own data, so they can be run from anywhere without touching
+# files/parts, e.g.: ./benchmark.py load -n 1000000
+#
+benchmarks = {}
+
+def addBenchmark(benchName, method):
+    if benchName is None or method is None or not callable(method):
+        raise ValueError("benchName can't be none, method must be callable")
+    global benchmarks
+    benchmarks[benchName.lower()] = method
+
+def _timed(method, *args):
+    "Returns (seconds taken, result) of method(*args)."
+    start = time.perf_counter()
+    result = method(*args)
+    return (time.perf_counter() - start, result)
+
+def _report(label, seconds, count):
+    print("{0:<32} {1:8.3f}s {2:12.0f} records/s".format(label, seconds,
+                                                       count / max(seconds, 1e-9)))
+
+def partLines(count):
+    "Returns count lines of a parts file."
+    return ['Part: id="{0}" description="part number {0}" footprint="fp{1}" '
+            'quantity="{2}"'.format(i, i % 97, i % 1000) for i in range(count)]
+
+def _legacyGenerate(fact, fromKv):
+    "How records got built before the shared schema: deepcopy, then setValue."
+    attrs = copy.deepcopy(fact.attrs)
+    for (key, value) in fromKv:
+        attrs[key].setValue(value)
+    return attrs
+
+def benchLoad(count):
+    "Record construction cost at load time, against the parsing it sits behind."
+    fact = inventory.getFactories()["Part"]
+    lines = partLines(count)
+
+    (t, kvs) = _timed(lambda: [parser.getKvPairs(parser.extractRecordName(x)[1])
+                               for x in lines])
+    _report("parse (getKvPairs)", t, count)
+
+    (t, _) = _timed(lambda: [_legacyGenerate(fact, x) for x in kvs])
+    _report("build (deepcopy, before)", t, count)
+
+    (t, _) = _timed(lambda: [fact.generateRecord(x) for x in kvs])
+    _report("build (generateRecord)", t, count)
+
+    (t, _) = _timed(fact.generateRecords, kvs)
+    _report("build (generateRecords)", t, count)
+
+def benchParse(count):
+    "Parse throughput, as lines/s and MB/s."
+    facts = inventory.getFactories()
+    lines = [x + '\n' for x in partLines(count)]
+    size = sum(len(x.encode()) for x in lines) / (1024.0 * 1024.0)
+
+    def report(label, seconds):
+        print("{0:<32} {1:8.3f}s {2:12.0f} lines/s {3:8.1f} MB/s".format(
+              label, seconds, count / max(seconds, 1e-9), size / max(seconds, 1e-9)))
+
+    (t, _) = _timed(lambda: [parser.processLine(x) for x in parser.iterLines(lines)])
+    report("tokenize (processLine)", t)
+
+    (t, _) = _timed(lambda: list(parser.parseStream(lines, facts)))
+    report("parse (parseStream)", t)
+
+def benchBatch(count):
+    "count add commands, one message at a time against one batch."
+    facts = inventory.getFactories()
+    messages = ['add\n' + x for x in partLines(count)]
+
+    def oneByOne():
+        recs = store.RecordStore(facts)
+        for x in messages:
+            protocol.interpretMessage(x, facts, recs)
+
+    (t, _) = _timed(oneByOne)
+    _report("add (interpretMessage)", t, count)
+
+    (t, _) = _timed(lambda: list(protocol.interpretMessages(messages, facts,
+                                                            store.RecordStore(facts))))
+    _report("add (interpretMessages)", t, count)
+
+def benchDelete(count):
+    "Wildcard deletes that take out most of a store."
+    facts = inventory.getFactories()
+    msg = 'rm\nPart: id="1*"'
+    recs = store.RecordStore(facts, parser.parseStream(partLines(count), facts))
+    before = len(recs)
+
+    (t, _) = _timed(protocol.interpretMessage, msg, facts, recs)
+    _report("rm (one wildcard)", t, before - len(recs))
+
+    recs = store.RecordStore(facts, parser.parseStream(partLines(count), facts))
+    (t, _) = _timed(lambda: [recs.remove(x) for x in list(recs)])
+    _report("remove (everything, one by one)", t, count)
+
+def benchStress(count, readers = 4, writers = 1, seconds = 2.0):
+    """readers threads listing a footprint while writers threads set the quantity
+of every part with some footprint at once, through one shared store. Every
+listing should see one quantity per footprint; 'torn' counts ones that didn't."""
+    facts = inventory.getFactories()
+    lines = ['Part: id="{0}" description="part {0}" footprint="fp{1}" quantity="{1}"'
+             .format(i, i % 97) for i in range(count)]
+
+    def run(lock):
+        recs = store.RecordStore(facts, parser.parseStream(lines, facts))
+        stop = threading.Event()
+        counts = {'read': 0, 'write': 0, 'torn': 0, 'errors': 0}
+        countLock = threading.Lock()
+
+        def reader(n):
+            rand = random.Random(n)
+            (done, torn, errors) = (0, 0, 0)
+            while not stop.is_set():
+                msg = 'list\nPart: footprint="fp{0}"'.format(rand.randrange(97))
+                try:
+                    (_, out) = protocol.interpretMessage(msg, facts, recs, lock)
+                except Exception:
+                    errors += 1
+                    continue
+                quantities = set(x.split('quantity="')[1] for x in (out or "").splitlines())
+                torn += len(quantities) > 1
+                done += 1
+            with countLock:
+                counts['read'] += done
+                counts['torn'] += torn
+                counts['errors'] += errors
+
+        def writer(n):
+            rand = random.Random(-n - 1)
+            (done, errors) = (0, 0)
+            while not stop.is_set():
+                msg = 'set\nPart: footprint="fp{0}"\nPart: quantity="{1}"'.format(
+                      rand.randrange(97), rand.randrange(1000))
+                try:
+                    protocol.interpretMessage(msg, facts, recs, lock)
+                except Exception:
+                    errors += 1
+                    continue
+                done += 1
+            with countLock:
+                counts['write'] += done
+                counts['errors'] += errors
+
+        threads = [threading.Thread(target = reader, args = (i,)) for i in range(readers)] + \
+                  [threading.Thread(target = writer, args = (i,)) for i in range(writers)]
+        for t in threads:
+            t.start()
+        time.sleep(seconds)
+        stop.set()
+        for t in threads:
+            t.join()
+        return counts
+
+    print("{0} parts, {1} readers, {2} writers, {3:.1f}s each".format(count, readers,
+                                                                       writers, seconds))
+    for (label, lock) in [("locked (RWLock)", locks.RWLock()), ("unlocked", None)]:
+        counts = run(lock)
+        print("{0:<32} {1:10.0f} reads/s {2:10.0f} writes/s {3:6d} torn {4:6d} errors".format(
+              label, counts['read'] / seconds, counts['write'] / seconds,
+              counts['torn'], counts['errors']))
+
+def benchShards(count):
+    "Full scans (a glob no index can answer), serially and over a ShardPool."
+    facts = inventory.getFactories()
+    recs = store.RecordStore(facts, parser.parseStream(partLines(count), facts))
+    matchRecs = [("Part", facts["Part"].generateMatchRecord([("id", "*5*")]))]
+
+    (t, _) = _timed(recs.match, matchRecs)
+    _report("scan (serial)", t, count)
+
+    for workers in sorted(set([2, os.cpu_count() or 1])):
+        pool = shards.ShardPool(workers, minEntries = 0)
+        (t, _) = _timed(pool.start)
+        print("{0:<32} {1:8.3f}s".format("start {0} processes".format(workers), t))
+        recs.setShards(pool)
+        # Scans go serially until they've taken as long as shipping the store.
+        (t, n) = (0.0, 0)
+        while pool.loadedFor is None:
+            (took, _) = _timed(recs.match, matchRecs)
+            (t, n) = (t + took, n + 1)
+        _report("scan ({0}, first {1} incl. ship)".format(workers, n), t, count * n)
+        (t, _) = _timed(recs.match, matchRecs)
+        _report("scan ({0}, store already there)".format(workers), t, count)
+        pool.close()
+    recs.setShards(None)
+
+def benchColumns(count):
+    "Lookups and sorts with and without the columnar backend (needs numpy)."
+    if not columns.available():
+        print("numpy isn't installed")
+        return
+    facts = inventory.getFactories()
+    lines = partLines(count)
+
+    for columnar in [False, True]:
+        label = "columnar" if columnar else "range index"
+        (t, recs) = _timed(lambda: store.RecordStore(facts, parser.parseStream(lines, facts),
+                                                     columnar = columnar))
+        _report("load ({0})".format(label), t, count)
+        # Exact criteria go to the hash index either way; ranges, the more of
+        # the store they take in, are where the column wins.
+        for criteria in ["13", "100..199", "<500"]:
+            matchRecs = [("Part", facts["Part"].generateMatchRecord([("quantity", criteria)]))]
+            (t, _) = _timed(lambda: [recs.match(matchRecs) for _ in range(10)])
+            _report("10x quantity={0} ({1})".format(criteria, label), t, count)
+
+    entries = [r for (_, r) in recs]
+    (t, _) = _timed(protocol._sortRecords, entries, ["quantity", "id"])
+    _report("sort by quantity, id (lexsort)", t, count)
+    key = protocol._sortKey(["quantity", "id"])
+    (t, _) = _timed(lambda: sorted(entries, key = key))
+    _report("sort by quantity, id (tuples)", t, count)
+
+def benchMatch(count):
+    "Matching every record against some criteria, per record and compiled once."
+    facts = inventory.getFactories()
+    recs = [r for (_, r) in parser.parseStream(partLines(count), facts)]
+
+    for kv in [[("id", "*5*")], [("id", "*5*"), ("quantity", "13")],
+               [("quantity", "<100"), ("description", "*9")]]:
+        m = facts["Part"].generateMatchRecord(kv)
+        print(" ".join('{0}="{1}"'.format(k, v) for (k, v) in kv))
+        compiled = m.compileCriteria()
+        (t, _) = _timed(lambda: [r for r in recs if r.meetsCriteria(m, compiled)])
+        _report("  per record (meetsCriteria)", t, count)
+        matches = m.compileMatcher()
+        (t, _) = _timed(lambda: [r for r in recs if matches(r)])
+        _report("  compiled (compileMatcher)", t, count)
+
+def benchCache(count, polls = 200):
+    "Dashboards polling the same few lists, with and without the result cache."
+    facts = inventory.getFactories()
+    recs = store.RecordStore(facts, parser.parseStream(partLines(count), facts))
+    messages = ['list\nPart: footprint="fp1*"\nsort Part by quantity\nlimit 20',
+                'list\nPart: id="*99"',
+                'list\nPart: quantity="<5"']
+
+    def poll():
+        for i in range(polls):
+            protocol.interpretMessage(messages[i % len(messages)], facts, recs)
+            # Every so often something changes.
+            if i % 50 == 49:
+                protocol.interpretMessage('set\nPart: id="{0}"\nPart: quantity="{1}"'.format(
+                                          i, i % 7), facts, recs)
+
+    for maxSize in [0, protocol.listCache.maxSize]:
+        protocol.listCache.clear()
+        (protocol.listCache.maxSize, oldSize) = (maxSize, protocol.listCache.maxSize)
+        (t, _) = _timed(poll)
+        protocol.listCache.maxSize = oldSize
+        info = protocol.listCache.info()
+        print("{0:<32} {1:8.3f}s {2:12.0f} polls/s {3:6.1%} hits".format(
+              "cache size {0}".format(maxSize), t, polls / max(t, 1e-9), info.hitRate))
+
+def benchUpdate(count):
+    "set on about a tenth of a store, one setAttribute at a time and in bulk."
+    facts = inventory.getFactories()
+    lines = partLines(count)
+    matchRecs = [("Part", facts["Part"].generateMatchRecord([("footprint", "fp1*")]))]
+    setRec = facts["Part"].generateMatchRecord([("quantity", "5"), ("description", "d")])
+
+    recs = store.RecordStore(facts, parser.parseStream(lines, facts))
+    def oneByOne():
+        found = recs.match(matchRecs)
+        for i in found:
+            for (k, v) in [z for z in setRec.items() if z[1] is not None]:
+                recs.setAttribute(i, k, v)
+        return len(found)
+    (t, updated) = _timed(oneByOne)
+    _report("set (setAttribute)", t, updated)
+
+    recs = store.RecordStore(facts, parser.parseStream(lines, facts))
+    (t, _) = _timed(protocol.interpretMessage,
+                    'set\nPart: footprint="fp1*"\nPart: quantity="5" description="d"',
+                    facts, recs)
+    _report("set (updateMany)", t, updated)
+
+def benchOutput(count):
+    "Listing and writing out a whole store, the first time and once it's formatted."
+    facts = inventory.getFactories()
+    recs = store.RecordStore(facts, parser.parseStream(partLines(count), facts))
+    path = os.path.join(tempfile.mkdtemp(), "parts")
+
+    try:
+        for label in ["first", "again"]:
+            protocol.listCache.clear()
+            (t, _) = _timed(protocol.interpretMessage, 'list', facts, recs)
+            _report("list ({0})".format(label), t, count)
+            (t, _) = _timed(inventory.commitRecords, path, recs)
+            _report("commit ({0})".format(label), t, count)
+    finally:
+        shutil.rmtree(os.path.dirname(path))
+
+addBenchmark('load', benchLoad)
+addBenchmark('parse', benchParse)
+addBenchmark('batch', benchBatch)
+addBenchmark('delete', benchDelete)
+addBenchmark('stress', benchStress)
+addBenchmark('shards', benchShards)
+addBenchmark('columns', benchColumns)
+addBenchmark('match', benchMatch)
+addBenchmark('cache', benchCache)
+addBenchmark('update', benchUpdate)
+addBenchmark('output', benchOutput)
+
+if __name__ == "__main__":
+    aparser = argparse.ArgumentParser(description="Run inventory benchmarks")
+    aparser.add_argument('benchmark', choices = sorted(benchmarks.keys()),
+                         help="Which benchmark to run")
+    aparser.add_argument('-n', '--count', metavar='count', type=int,
+                         default=100000, help="How many records to use")
+
+    aparser.add_argument('-r', '--readers', metavar='threads', type=int,
+                         help="Reader threads (stress only)")
+    aparser.add_argument('-w', '--writers', metavar='threads', type=int,
+                         help="Writer threads (stress only)")
+
+    parsed = aparser.parse_args(sys.argv[1:])
+    threads = dict((k, v) for (k, v) in [('readers', parsed.readers),
+                                         ('writers', parsed.writers)] if v is not None)
+    if len(threads) > 0 and parsed.benchmark != 'stress':
+        aparser.error("only the stress benchmark takes -r/-w")
+    benchmarks[parsed.benchmark](parsed.count, **threads)
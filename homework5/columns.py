@@ -0,0 +1,305 @@
+#!/usr/bin/python
+
+import attribute
+import threading
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#
+# Columnar backend:
+# Optional (it needs numpy) ways of working on whole columns of values at once
+# instead of a record at a time. ColumnIndex keeps an int or float attribute
+# in a NumPy array, so criteria get answered by comparing the whole column in
+# one go. That costs O(n) however few records match, so it's no match for a
+# hash index on exact criteria, but it beats walking a sorted index for ranges
+# that take in a good part of the store. sortOrder sorts records by several columns with one lexsort, with
+# str columns dictionary-encoded into ints first.
+#
+_dtypes = {int: 'int64', float: 'float64'}
+_int64 = (-2**63, 2**63)
+
+# Below this many records, sorting tuples in Python is quicker than building
+# the columns.
+SORT_MIN = 1000
+
+def available():
+    "Returns whether numpy is around for the columnar backend."
+    return numpy is not None
+
+class ColumnIndex:
+    """Keeps the values of an int or float attribute in one NumPy array, with the
+sequence numbers of their records in another. Adds get buffered and appended
+in bulk by the next lookup; removes just mark their slot dead, and the dead
+slots get squeezed out once they're half the column. ints too big for an int64
+are kept on the side in a dict. Lookups can run side by side (say, readers of
+a server), so the flush they might do has a lock of its own."""
+    def __init__(self, attrName, type_ = int):
+        if numpy is None:
+            raise ValueError("Column indexes need numpy")
+        if attrName is None:
+            raise ValueError("Can't index a None attribute")
+        if type_ not in _dtypes:
+            raise ValueError("Column indexes only work on int and float attributes")
+        self.attrName = attrName
+        self.type_ = type_
+        self.seqs = numpy.empty(0, dtype = 'int64')
+        self.values = numpy.empty(0, dtype = _dtypes[type_])
+        self.live = numpy.empty(0, dtype = bool)
+        self.at = {}
+        self.pending = []
+        self.dead = 0
+        self.overflow = {}
+        self.flushLock = threading.Lock()
+
+    def __len__(self):
+        return len(self.at) + sum(len(x) for x in self.overflow.values())
+
+    def _fits(self, value):
+        return self.type_ is not int or _int64[0] <= value < _int64[1]
+
+    def _flush(self):
+        "Appends the pending adds. Returns the (seqs, values, live) columns after."
+        with self.flushLock:
+            if len(self.pending) > 0:
+                (seqs, values) = zip(*self.pending)
+                self.seqs = numpy.concatenate([self.seqs, numpy.array(seqs, dtype = 'int64')])
+                self.values = numpy.concatenate([self.values,
+                                                 numpy.array(values, dtype = self.values.dtype)])
+                self.live = numpy.concatenate([self.live, numpy.ones(len(seqs), dtype = bool)])
+                self.pending = []
+            return (self.seqs, self.values, self.live)
+
+    def _compact(self):
+        keep = self.live
+        self.seqs = self.seqs[keep]
+        self.values = self.values[keep]
+        self.live = numpy.ones(len(self.seqs), dtype = bool)
+        self.at = dict(zip(self.seqs.tolist(), range(len(self.seqs))))
+        self.dead = 0
+
+    def add(self, seq, rec):
+        value = rec.getAttribute(self.attrName)
+        if value is None:
+            return
+        if not self._fits(value):
+            self.overflow.setdefault(value, set()).add(seq)
+            return
+        self.at[seq] = len(self.seqs) + len(self.pending)
+        self.pending.append((seq, value))
+
+    def addMany(self, seqRecs):
+        "Like add on every (seq, rec) pair, but buffers them all in one go."
+        new = [(seq, rec.getAttribute(self.attrName)) for (seq, rec) in seqRecs]
+        new = [x for x in new if x[1] is not None]
+        if len(new) == 0:
+            return
+        if self.type_ is int:
+            values = [v for (_, v) in new]
+            if not (self._fits(min(values)) and self._fits(max(values))):
+                for (seq, value) in new:
+                    if self._fits(value):
+                        self.at[seq] = len(self.seqs) + len(self.pending)
+                        self.pending.append((seq, value))
+                    else:
+                        self.overflow.setdefault(value, set()).add(seq)
+                return
+        start = len(self.seqs) + len(self.pending)
+        self.at.update(zip([seq for (seq, _) in new], range(start, start + len(new))))
+        self.pending.extend(new)
+
+    def remove(self, seq, rec):
+        value = rec.getAttribute(self.attrName)
+        if value is not None and not self._fits(value):
+            bucket = self.overflow.get(value, set())
+            bucket.discard(seq)
+            if len(bucket) == 0:
+                self.overflow.pop(value, None)
+            return
+
+        at = self.at.pop(seq, None)
+        if at is None:
+            return
+        self._flush()
+        self.live[at] = False
+        self.dead += 1
+        if self.dead * 2 > len(self.seqs):
+            self._compact()
+
+    def removeMany(self, seqRecs):
+        for (seq, rec) in seqRecs:
+            self.remove(seq, rec)
+
+    def canLookup(self, criteriaStr):
+        "Returns whether criteriaStr is an exact match or a range this index can answer."
+        return criteriaStr is not None and not attribute.isBasicRegex(criteriaStr)
+
+    def _beyond(self, values, bound, include, above):
+        """Returns the mask of values above (or below) bound, or just True or False
+when bound is past what the column can hold."""
+        if self.type_ is int and not self._fits(bound):
+            return (bound < 0) == above
+        if above:
+            return values >= bound if include else values > bound
+        return values <= bound if include else values < bound
+
+    def lookup(self, criteriaStr):
+        """Returns the set of sequence numbers whose value equals criteriaStr, or is
+in its range (see attribute.getRange)."""
+        bounds = attribute.getRange(self.type_, criteriaStr)
+        if bounds is None:
+            try:
+                value = self.type_(criteriaStr)
+            except:
+                return set()
+            if not self._fits(value):
+                return set(self.overflow.get(value, set()))
+            (seqs, values, live) = self._flush()
+            return set(seqs[(values == value) & live].tolist())
+
+        (low, high, includeLow, includeHigh) = bounds
+        (seqs, values, live) = self._flush()
+        mask = live
+        if low is not None:
+            mask = mask & self._beyond(values, low, includeLow, True)
+        if high is not None:
+            mask = mask & self._beyond(values, high, includeHigh, False)
+        result = set(seqs[mask].tolist())
+        for (value, bucket) in self.overflow.items():
+            if attribute.inRange(value, bounds):
+                result.update(bucket)
+        return result
+
+def _encode(column):
+    """Returns column (a list of values) as an array that sorts the same way, or
+None if it can't be made into one."""
+    values = [v for v in column if v is not None]
+    types = set(type(v) for v in values)
+    if len(types) == 0:
+        return numpy.zeros(len(column), dtype = 'int64')
+    if types <= {int, float}:
+        dtype = 'float64' if float in types else 'int64'
+        try:
+            return numpy.array([0 if v is None else v for v in column], dtype = dtype)
+        except OverflowError:
+            return None
+    if types == {str}:
+        # Fixed width unicode sorts by code point like str does, but drops
+        # trailing NULs, so strings that have them go the slow way.
+        if any(v.endswith('\x00') for v in values):
+            codes = dict((v, i) for (i, v) in enumerate(sorted(set(values))))
+            return numpy.array([0 if v is None else codes[v] for v in column], dtype = 'int64')
+        (_, codes) = numpy.unique(numpy.array(['' if v is None else v for v in column]),
+                                  return_inverse = True)
+        return codes.reshape(-1)
+    return None
+
+def sortOrder(columns):
+    """Given the values of the fields to sort by (one list per field, most
+significant first), returns the indexes of the records in sorted order. Like
+sorting by (v is None, v) tuples: stable, with Nones last. Returns None if a
+column mixes types that don't compare."""
+    keys = []
+    for column in columns:
+        encoded = _encode(column)
+        if encoded is None:
+            return None
+        missing = numpy.array([v is None for v in column], dtype = bool)
+        if missing.any():
+            keys.append(missing)
+        keys.append(encoded)
+    if len(keys) == 0:
+        return None
+    # lexsort takes its most significant key last.
+    return numpy.lexsort(keys[::-1]).tolist()
+
+@unittest.skipUnless(available(), "needs numpy")
+class ColumnTests(unittest.TestCase):
+    class FakeRecord:
+        def __init__(self, **kwargs):
+            self.values = kwargs
+
+        def getAttribute(self, attrStr):
+            return self.values.get(attrStr)
+
+    def test_index(self):
+        rec = ColumnTests.FakeRecord
+        self.assertRaises(ValueError, ColumnIndex, "id", str)
+
+        idx = ColumnIndex("quantity", int)
+        idx.add(0, rec(quantity = 13))
+        idx.addMany([(1, rec(quantity = 13)), (2, rec(quantity = 8)), (3, rec()),
+                     (4, rec(quantity = 2**70))])
+        self.assertEqual(len(idx), 4)
+        self.assertTrue(idx.canLookup("13"))
+        self.assertTrue(idx.canLookup("<13"))
+        self.assertFalse(idx.canLookup("1*"))
+
+        self.assertEqual(idx.lookup("13"), {0, 1})
+        self.assertEqual(idx.lookup("013"), {0, 1})
+        self.assertEqual(idx.lookup("lol"), set())
+        self.assertEqual(idx.lookup(str(2**70)), {4})
+        self.assertEqual(idx.lookup("<13"), {2})
+        self.assertEqual(idx.lookup("<=13"), {0, 1, 2})
+        self.assertEqual(idx.lookup(">8"), {0, 1, 4})
+        self.assertEqual(idx.lookup("9..13"), {0, 1})
+        self.assertEqual(idx.lookup(">" + str(2**64)), {4})
+        self.assertEqual(idx.lookup(">" + str(2**71)), set())
+        self.assertEqual(idx.lookup("<" + str(-2**64)), set())
+        self.assertEqual(idx.lookup("<" + str(2**64)), {0, 1, 2})
+
+        idx.remove(0, rec(quantity = 13))
+        idx.remove(9, rec(quantity = 13))
+        self.assertEqual(idx.lookup("13"), {1})
+        idx.add(5, rec(quantity = 13))
+        idx.remove(2, rec(quantity = 8))
+        idx.remove(4, rec(quantity = 2**70))
+        self.assertEqual(idx.lookup("13"), {1, 5})
+        self.assertEqual(idx.lookup("8"), set())
+        self.assertEqual(idx.lookup(">=0"), {1, 5})
+        self.assertEqual(len(idx), 2)
+
+        idx = ColumnIndex("price", float)
+        idx.addMany([(0, rec(price = 0.5)), (1, rec(price = 2.0)), (2, rec(price = -1.5))])
+        self.assertEqual(idx.lookup("<1"), {0, 2})
+        self.assertEqual(idx.lookup("0.5..2"), {0, 1})
+        self.assertEqual(idx.lookup("2"), {1})
+
+    def test_readers(self):
+        rec = ColumnTests.FakeRecord
+        idx = ColumnIndex("quantity", int)
+        for round_ in range(20):
+            # Every reader lands on a fresh batch of pending adds at once.
+            idx.addMany([(round_ * 1000 + i, rec(quantity = i % 10)) for i in range(1000)])
+            start = threading.Barrier(8)
+            found = []
+            def read():
+                start.wait()
+                found.append(len(idx.lookup("3")))
+            readers = [threading.Thread(target = read) for _ in range(8)]
+            for t in readers:
+                t.start()
+            for t in readers:
+                t.join()
+            self.assertEqual(found, [100 * (round_ + 1)] * 8)
+        self.assertEqual(len(idx.seqs), 20000)
+        self.assertEqual(idx.pending, [])
+
+    def test_sortOrder(self):
+        quantity = [5, None, 2, 5, 2]
+        ids = ["b", "a", "z", "a", None]
+        for cols in [[quantity], [quantity, ids], [ids, quantity], [ids]]:
+            expect = sorted(range(5), key = lambda i: tuple(
+                x for c in cols for x in (c[i] is None, c[i])))
+            self.assertEqual(sortOrder(cols), expect)
+        self.assertEqual(sortOrder([[1, 2.5, 0]]), [2, 0, 1])
+        self.assertIsNone(sortOrder([[1, "a"]]))
+        self.assertIsNone(sortOrder([[2**70, 1]]))
+        self.assertEqual(sortOrder([["a\x00", "a", None, "\u00e9", "b"]]), [1, 0, 4, 3, 2])
+        self.assertEqual(sortOrder([["a", "", None, "\u00e9", "b"]]), [1, 0, 4, 3, 2])
+
+if __name__ == '__main__':
+    unittest.main()
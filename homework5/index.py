@@ -0,0 +1,282 @@
+#!/usr/bin/python
+
+import attribute
+import bisect
+import unittest
+
+#
+# Index classes:
+# An index maps attribute values to the sequence numbers of the records that
+# hold them, so a store can answer a criteria lookup without touching every
+# record. Indexes only ever see records of one type, and are told about every
+# add/remove by the store that owns them. A lookup returns exactly the records
+# meeting its criteria (the same ones attribute.compileCriteria would pick), so
+# a store doesn't have to check them over again.
+#
+class HashIndex:
+    def __init__(self, attrName, type_ = str):
+        if attrName is None:
+            raise ValueError("Can't index a None attribute")
+        self.attrName = attrName
+        self.type_ = type_
+        self.buckets = {}
+
+    def __len__(self):
+        return sum(len(x) for x in self.buckets.values())
+
+    def add(self, seq, rec):
+        "Indexes rec under seq."
+        value = rec.getAttribute(self.attrName)
+        if value is None:
+            return
+        bucket = self.buckets.get(value)
+        if bucket is None:
+            bucket = self.buckets[value] = set()
+        bucket.add(seq)
+
+    def addMany(self, seqRecs):
+        for (seq, rec) in seqRecs:
+            self.add(seq, rec)
+
+    def remove(self, seq, rec):
+        "Drops rec (indexed under seq) from the index."
+        value = rec.getAttribute(self.attrName)
+        if value is None:
+            return
+        bucket = self.buckets.get(value)
+        if bucket is None:
+            return
+        bucket.discard(seq)
+        if len(bucket) == 0:
+            del self.buckets[value]
+
+    def removeMany(self, seqRecs):
+        for (seq, rec) in seqRecs:
+            self.remove(seq, rec)
+
+    def canLookup(self, criteriaStr):
+        "Returns whether criteriaStr is an exact match this index can answer."
+        return criteriaStr is not None and not attribute.isBasicRegex(criteriaStr) \
+               and attribute.getRange(self.type_, criteriaStr) is None
+
+    def lookup(self, criteriaStr):
+        "Returns the set of sequence numbers whose value equals criteriaStr."
+        try:
+            value = self.type_(criteriaStr)
+        except:
+            return set()
+        return self.buckets.get(value, set())
+
+class SortedIndex:
+    """Keeps (value, seq) pairs for a string attribute in sorted order, so
+prefix criteria like "1*" can be answered with a bisect and a short walk."""
+    insortLimit = 64
+
+    def __init__(self, attrName, type_ = str):
+        if attrName is None:
+            raise ValueError("Can't index a None attribute")
+        if type_ is not str:
+            raise ValueError("Sorted indexes only work on str attributes")
+        self.attrName = attrName
+        self.type_ = type_
+        self.items = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, seq, rec):
+        value = rec.getAttribute(self.attrName)
+        if value is None:
+            return
+        bisect.insort(self.items, (value, seq))
+
+    def addMany(self, seqRecs):
+        """Adds every (seq, rec) pair with one sort rather than an insort each.
+A handful of pairs still get insorted, since even a sort of an almost sorted
+list has to compare everything once."""
+        new = [(rec.getAttribute(self.attrName), seq) for (seq, rec) in seqRecs]
+        new = [x for x in new if x[0] is not None]
+        if len(new) <= SortedIndex.insortLimit:
+            for x in new:
+                bisect.insort(self.items, x)
+        else:
+            self.items.extend(new)
+            self.items.sort()
+
+    def remove(self, seq, rec):
+        value = rec.getAttribute(self.attrName)
+        if value is None:
+            return
+        at = bisect.bisect_left(self.items, (value, seq))
+        if at < len(self.items) and self.items[at] == (value, seq):
+            del self.items[at]
+
+    def removeMany(self, seqRecs):
+        """Drops every (seq, rec) pair. Past a handful, that's one pass over the
+index rather than a delete (and the shuffle after it) each."""
+        if len(seqRecs) <= SortedIndex.insortLimit:
+            for (seq, rec) in seqRecs:
+                self.remove(seq, rec)
+            return
+        dropped = set(seq for (seq, _) in seqRecs)
+        self.items = [x for x in self.items if x[1] not in dropped]
+
+    def canLookup(self, criteriaStr):
+        return attribute.getPrefix(criteriaStr) is not None
+
+    def lookup(self, criteriaStr):
+        "Returns the set of sequence numbers whose value starts with the prefix."
+        prefix = attribute.getPrefix(criteriaStr)
+        result = set()
+        at = bisect.bisect_left(self.items, (prefix,))
+        while at < len(self.items) and self.items[at][0].startswith(prefix):
+            result.add(self.items[at][1])
+            at += 1
+        return result
+
+class RangeIndex(SortedIndex):
+    """A SortedIndex over an int or float attribute, for range criteria like "<10"
+or "5..20" (see attribute.getRange): two bisects find where the range starts
+and ends, so a lookup costs O(log n + matches)."""
+    def __init__(self, attrName, type_ = int):
+        if attrName is None:
+            raise ValueError("Can't index a None attribute")
+        if type_ not in attribute.rangeTypes:
+            raise ValueError("Range indexes only work on int and float attributes")
+        self.attrName = attrName
+        self.type_ = type_
+        self.items = []
+
+    def canLookup(self, criteriaStr):
+        return attribute.getRange(self.type_, criteriaStr) is not None
+
+    def lookup(self, criteriaStr):
+        "Returns the set of sequence numbers whose value is in the range."
+        (low, high, includeLow, includeHigh) = attribute.getRange(self.type_, criteriaStr)
+        last = float('inf')
+
+        start = 0
+        if low is not None:
+            if includeLow:
+                start = bisect.bisect_left(self.items, (low,))
+            else:
+                start = bisect.bisect_right(self.items, (low, last))
+        end = len(self.items)
+        if high is not None:
+            if includeHigh:
+                end = bisect.bisect_right(self.items, (high, last))
+            else:
+                end = bisect.bisect_left(self.items, (high,))
+        return set(seq for (_, seq) in self.items[start:end])
+
+class IndexTests(unittest.TestCase):
+    class FakeRecord:
+        def __init__(self, **kwargs):
+            self.values = kwargs
+
+        def getAttribute(self, attrStr):
+            return self.values.get(attrStr)
+
+    def test_hash(self):
+        rec = IndexTests.FakeRecord
+        idx = HashIndex("quantity", int)
+        idx.add(0, rec(quantity = 13))
+        idx.add(1, rec(quantity = 13))
+        idx.add(2, rec(quantity = 8))
+        idx.add(3, rec())
+        self.assertEqual(len(idx), 3)
+
+        self.assertTrue(idx.canLookup("13"))
+        self.assertFalse(idx.canLookup("1*"))
+        self.assertFalse(idx.canLookup(None))
+
+        self.assertEqual(idx.lookup("13"), {0, 1})
+        self.assertEqual(idx.lookup("013"), {0, 1})
+        self.assertEqual(idx.lookup("8"), {2})
+        self.assertEqual(idx.lookup("9"), set())
+        self.assertEqual(idx.lookup("hello"), set())
+
+        idx.remove(0, rec(quantity = 13))
+        self.assertEqual(idx.lookup("13"), {1})
+        idx.remove(1, rec(quantity = 13))
+        self.assertEqual(idx.lookup("13"), set())
+        self.assertNotIn(13, idx.buckets)
+
+        # Removing things that were never added is harmless.
+        idx.remove(3, rec())
+        idx.remove(7, rec(quantity = 99))
+        self.assertEqual(len(idx), 1)
+        idx.removeMany([(2, rec(quantity = 8)), (8, rec(quantity = 8))])
+        self.assertEqual(len(idx), 0)
+
+    def test_sorted(self):
+        rec = IndexTests.FakeRecord
+        self.assertRaises(ValueError, SortedIndex, "quantity", int)
+
+        idx = SortedIndex("id")
+        for (seq, i) in enumerate(["12", "1", "2"]):
+            idx.add(seq, rec(id = i))
+        idx.addMany([(3, rec(id = "10")), (4, rec(id = "U240")), (5, rec(id = "12")), (6, rec())])
+        self.assertEqual(len(idx), 6)
+
+        self.assertTrue(idx.canLookup("1*"))
+        self.assertTrue(idx.canLookup("*"))
+        self.assertFalse(idx.canLookup("1"))
+        self.assertFalse(idx.canLookup("*1"))
+        self.assertFalse(idx.canLookup("1*2*"))
+
+        self.assertEqual(idx.lookup("1*"), {0, 1, 3, 5})
+        self.assertEqual(idx.lookup("12*"), {0, 5})
+        self.assertEqual(idx.lookup("U*"), {4})
+        self.assertEqual(idx.lookup("3*"), set())
+        self.assertEqual(idx.lookup("*"), {0, 1, 2, 3, 4, 5})
+
+        # Big batches get sorted in, small ones insorted; same result either way.
+        big = SortedIndex("id")
+        big.addMany([(i, rec(id = str(i))) for i in range(200)])
+        big.addMany([(200, rec(id = "5")), (201, rec(id = "50"))])
+        self.assertEqual(big.items, sorted(big.items))
+        self.assertEqual(big.lookup("50*"), {50, 201})
+
+        big.removeMany([(i, None) for i in range(0, 200, 2)])
+        self.assertEqual(len(big), 102)
+        self.assertEqual(big.lookup("50*"), {201})
+
+        idx.remove(0, rec(id = "12"))
+        idx.remove(6, rec())
+        idx.remove(9, rec(id = "12"))
+        self.assertEqual(idx.lookup("12*"), {5})
+        self.assertEqual(len(idx), 5)
+
+    def test_range(self):
+        rec = IndexTests.FakeRecord
+        self.assertRaises(ValueError, RangeIndex, "id", str)
+
+        idx = RangeIndex("quantity", int)
+        idx.addMany([(i, rec(quantity = q)) for (i, q) in enumerate([5, 10, 10, 20, 0, -3])])
+        idx.add(6, rec())
+        self.assertEqual(len(idx), 6)
+
+        self.assertTrue(idx.canLookup("<10"))
+        self.assertTrue(idx.canLookup("5..20"))
+        self.assertFalse(idx.canLookup("10"))
+        self.assertFalse(idx.canLookup("1*"))
+
+        self.assertEqual(idx.lookup("<10"), {0, 4, 5})
+        self.assertEqual(idx.lookup("<=10"), {0, 1, 2, 4, 5})
+        self.assertEqual(idx.lookup(">10"), {3})
+        self.assertEqual(idx.lookup(">=10"), {1, 2, 3})
+        self.assertEqual(idx.lookup("5..10"), {0, 1, 2})
+        self.assertEqual(idx.lookup("..0"), {4, 5})
+        self.assertEqual(idx.lookup("21.."), set())
+        self.assertEqual(idx.lookup("20..5"), set())
+
+        idx.remove(1, rec(quantity = 10))
+        self.assertEqual(idx.lookup("10..10"), {2})
+
+        # Hash indexes leave ranges to range indexes.
+        self.assertFalse(HashIndex("quantity", int).canLookup("<10"))
+        self.assertTrue(HashIndex("id", str).canLookup("<10"))
+
+if __name__ == '__main__':
+    unittest.main()
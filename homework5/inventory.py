@@ -2,85 +2,133 @@
 
 import parser
 import record
+import journal
 import protocol
-import attribute
+import snapshot
+import server
+import shards
+import store
 import sys
 import os
 import argparse
+import asyncio
+import functools
+import types
+
+def iterRecords(filePath, facts = None):
+    """Yields the (name, Record) entries in filePath. They come from its binary
+snapshot if that's up to date, and otherwise get parsed as they're read,
+without reading the whole file in first."""
+    if facts is None:
+        facts = getFactories()
+    assert facts is not None
 
-def _toFactory(*attrs, factoryType = None):
-    """Converts the name and attributes to a factory.
-Each attribute must be in the form (name, type[, default value]),
-otherwise this will fail."""
-    if attrs is None or len(attrs) == 0:
-        raise ValueError("attrs must be len > 0 and not None")
-
-    fact = record.RecordFactory()
-    if factoryType is not None:
-        fact.setFactoryType(factoryType)
-
-    for i in attrs:
-        assert len(i) in [2, 3]
-        attr = attribute.Attribute()
-        name = None
-        if len(i) == 3:
-            (name, attrType, attrDefault) = i
-            attr.setType(attrType)
-            attr.setValue(attrDefault)
-        elif len(i) == 2:
-            (name, attrType) = i
-            attr.setType(attrType)
-        if name is None:
-            raise ValueError("Can't assign None name to attribute")
-        fact.addAttribute(name, attr)
-    
-    return fact
+    snap = snapshot.readSnapshot(filePath, facts)
+    if snap is not None:
+        for i in snap:
+            yield i
+        return
 
-def readRecords(filePath):
-    facts = getFactories()
-    assert facts is not None
     with open(filePath, 'r') as fi:
-        txt = fi.read()
+        for i in parser.parseStream(fi, facts):
+            yield i
 
-    if txt is not None and len(txt.rstrip().lstrip()) > 0:
-        records = parser.parseTextBlock(txt, facts)
-    else:
+def readRecords(filePath):
+    records = list(iterRecords(filePath))
+    if len(records) == 0:
         return None
+    return records
 
-    return records['Record']
+def _recordLines(records):
+    "Yields the line each (name, Record) in records gets written as."
+    for x in records:
+        try:
+            yield x[0] + ": " + str(x[1]) + '\n'
+        except Exception as e:
+            print("Failed to write a record! :( (" + str(e) + ")")
 
-def commitRecords(filePath, records):
+def commitRecords(filePath, records, header = None, facts = None):
+    """Writes records to filePath, after header (a line) if there is one. They're
+written to a temporary file that then replaces filePath, so a store that's
+still reading (or mapping) the old file keeps working while we write. If facts
+are given, a binary snapshot for the next startup gets written too."""
     if records is None:
         records = []
     else:
-        records = [x for x in records if x is not None 
+        records = (x for x in records if x is not None 
                                       and x[0] is not None
-                                      and x[1] is not None]
-
-    with open(filePath, 'w') as fi:
-        for x in records:
-            try:
-                fi.write(x[0] + ": " + str(x[1]) + '\n')
-            except Exception as e:
-                print("Failed to write a record! :( (" + str(e) + ")")
+                                      and x[1] is not None)
+        if facts is not None:
+            records = list(records)
+
+    tmpPath = filePath + '.tmp'
+    with open(tmpPath, 'w') as fi:
+        if header is not None:
+            fi.write(header + '\n')
+        fi.writelines(_recordLines(records))
+        fi.flush()
+        os.fsync(fi.fileno())
+    os.replace(tmpPath, filePath)
+
+    # A snapshot that doesn't get rewritten here no longer matches filePath, so
+    # it won't be used.
+    if facts is not None:
+        snapshot.writeSnapshot(filePath, records, facts)
+
+#
+# Schema registry:
+# The record factories are built once, frozen, and shared by everything that
+# reads, matches or writes records, rather than rebuilt for every command.
+# factoryDefinitions says what they are; reloadFactories() rebuilds them if it
+# changes. Records that already exist keep the schema they were built with.
+#
+factoryDefinitions = {"Part": (("id", str),
+                               ("description", str),
+                               ("footprint", str),
+                               ("quantity", int))}
+_factories = None
+
+def reloadFactories(definitions = None):
+    """Rebuilds the factories from definitions (which then replace
+factoryDefinitions), or from factoryDefinitions. Returns the new factories."""
+    global factoryDefinitions, _factories
+    if definitions is not None:
+        factoryDefinitions = definitions
+
+    facts = {}
+    for (name, attrs) in factoryDefinitions.items():
+        facts[name] = record.toFactory(*attrs).freeze()
+    _factories = types.MappingProxyType(facts)
+    return _factories
 
 def getFactories():
     "Returns all standard factories for records."
-    # Part record
-    try:
-        cfact = _toFactory(("id", str), 
-                           ("description", str), 
-                           ("footprint", str), 
-                           ("quantity", int))
-    except e:
-        sys.stderr.write(str(e) + "\n")
-        return None
-    return {"Part": cfact}
+    if _factories is None:
+        try:
+            return reloadFactories()
+        except Exception as e:
+            sys.stderr.write(str(e) + "\n")
+            return None
+    return _factories
 
 if __name__ == "__main__":
     aparser = argparse.ArgumentParser(description="Show available parts")
     aparser.add_argument('-f', '--file', metavar='file',
                         help="File to read from/write to")
+    aparser.add_argument('-l', '--lazy', action='store_true',
+                        help="Map the file and only parse the records queries touch")
+    aparser.add_argument('-j', '--journal', action='store_true',
+                        help="Journal changes as they happen instead of rewriting the file on exit")
+    aparser.add_argument('-b', '--batch', metavar='commands', nargs='?', const='-',
+                        help="Run every command in a file (or stdin) in one go")
+    aparser.add_argument('-c', '--columnar', action='store_true',
+                        help="Keep numeric attributes in NumPy columns (needs numpy)")
+    aparser.add_argument('-P', '--processes', metavar='count', type=int,
+                        help="Scan big inventories with this many processes")
+    aparser.add_argument('-s', '--socket', metavar='path',
+                        help="Serve the inventory to clients on a Unix socket at path")
+    aparser.add_argument('-p', '--port', metavar='port', type=int,
+                        help="Serve the inventory to clients on localhost:port")
     
     parsed = aparser.parse_args(sys.argv[1:])
 
@@ -94,13 +142,78 @@ if __name__ == "__main__":
         sys.stderr.write("File must exist.\n")
         sys.exit(2)
 
+    facts = getFactories()
+
     try:
-        recs = readRecords(targFile)
+        if parsed.lazy:
+            recs = store.MappedRecordStore(facts, targFile)
+        else:
+            recs = store.RecordStore(facts, iterRecords(targFile, facts),
+                                     columnar = parsed.columnar)
     except Exception as e:
         sys.stderr.write("Error reading file. " + str(e) + "\n")
         sys.exit(3)
 
-    keepGoing = True
+    if parsed.processes is not None and not parsed.lazy:
+        # Started now, before there are any server threads around.
+        recs.setShards(shards.ShardPool(parsed.processes))
+        recs.shards.start()
+
+    # The lazy store's whole point is not holding everything at once, so it
+    # doesn't get a snapshot written.
+    if parsed.lazy:
+        commit = commitRecords
+    else:
+        commit = functools.partial(commitRecords, facts = facts)
+
+    # A journal left behind by an earlier session always gets replayed, even
+    # if this session isn't journaling, so nothing it has gets lost.
+    journ = None
+    if parsed.journal or os.path.exists(journal.journalPath(targFile)):
+        journ = journal.Journal(targFile)
+        journ.replay(facts, recs)
+        if parsed.journal:
+            protocol.addListener(journ.record)
+
+    def report(res, strres):
+        if res is False:
+            sys.stderr.write("Operation failed!\n")
+            if strres is not None:
+                sys.stderr.write(strres + "\n")
+        else:
+            if strres is not None:
+                print(strres)
+            else:
+                print('OK')
+
+        if parsed.journal:
+            journ.maybeCompact(recs, commit)
+
+    if parsed.batch is not None:
+        try:
+            batch = sys.stdin if parsed.batch == '-' else open(parsed.batch, 'r')
+        except OSError as e:
+            sys.stderr.write("Error reading commands. " + str(e) + "\n")
+            sys.exit(5)
+        with batch:
+            for (_, result) in protocol.interpretMessages(protocol.iterMessages(batch),
+                                                          facts, recs):
+                report(*result)
+
+    serving = parsed.socket is not None or parsed.port is not None
+    if serving:
+        afterWrite = None
+        if parsed.journal:
+            afterWrite = lambda records: journ.maybeCompact(records, commit)
+        srv = server.InventoryServer(facts, recs, afterWrite = afterWrite,
+                                     sharedReads = not parsed.lazy)
+        try:
+            asyncio.run(srv.serve(path = parsed.socket, port = parsed.port))
+        except (ValueError, OSError) as e:
+            sys.stderr.write("Couldn't serve. " + str(e) + "\n")
+            sys.exit(6)
+
+    keepGoing = parsed.batch is None and not serving
 
     while keepGoing:
         instream = ""
@@ -116,19 +229,15 @@ if __name__ == "__main__":
         instream = instream.rstrip().lstrip()
 
         if len(instream) > 0:
-            if recs is None:
-                recs = []
-
-            (res, strres) = protocol.interpretMessage(instream, getFactories(), recs)
+            report(*protocol.interpretMessage(instream, facts, recs))
 
-            if res is False:
-                sys.stderr.write("Operation failed!\n")
-                if strres is not None:
-                    sys.stderr.write(strres + "\n")
-            else:
-                if strres is not None:
-                    print(strres)
-                else:
-                    print('OK')
-
-    commitRecords(targFile, recs)
+    if parsed.journal:
+        journ.close()
+    else:
+        commit(targFile, recs)
+        if journ is not None:
+            journ.discard()
+    if parsed.lazy:
+        recs.close()
+    elif recs.shards is not None:
+        recs.shards.close()
@@ -0,0 +1,263 @@
+#!/usr/bin/python
+
+import os
+import parser
+import protocol
+import re
+import record
+import shutil
+import store
+import tempfile
+import threading
+import unittest
+
+def journalPath(filePath):
+    "Where the journal for the inventory at filePath lives."
+    return filePath + '.journal'
+
+def readApplied(filePath):
+    """Returns the id of the last journal entry folded into filePath, from its
+'#journal <id>' header line, or 0 if it doesn't have one."""
+    try:
+        with open(filePath, 'r') as fi:
+            match = re.match(r'#journal\s+(\d+)\s*$', fi.readline())
+    except FileNotFoundError:
+        return 0
+    return 0 if match is None else int(match.group(1))
+
+def readEntries(path):
+    """Yields the (id, message) entries in the journal at path. A torn entry at
+the end (from a crash mid-write) and anything after it is ignored."""
+    try:
+        fi = open(path, 'rb')
+    except FileNotFoundError:
+        return
+
+    with fi:
+        while True:
+            header = re.match(rb'#(\d+) (\d+)\n\Z', fi.readline())
+            if header is None:
+                return
+            length = int(header.group(2))
+            data = fi.read(length + 1)
+            if len(data) != length + 1 or not data.endswith(b'\n'):
+                return
+            yield (int(header.group(1)), data[:-1].decode())
+
+#
+# Journal class:
+# An append-only log of the mutating messages a session ran, so a commit only
+# has to write what changed. Every message gets an increasing id and is
+# fsync()ed before the caller hears it succeeded; replaying the journal on top
+# of the inventory file rebuilds the session after a crash.
+#
+# Compaction folds the journal into the inventory file: it writes the current
+# records with a '#journal <id>' header (readers skip it as a modifier line)
+# and then drops the entries up to <id> from the journal. Entries the file
+# already has are skipped on replay, so crashing halfway through a compaction
+# never applies anything twice.
+#
+class Journal:
+    def __init__(self, filePath, compactAfter = 10000):
+        if filePath is None:
+            raise ValueError("Need an inventory file to journal")
+        self.filePath = filePath
+        self.path = journalPath(filePath)
+        self.compactAfter = compactAfter
+        self.lock = threading.Lock()
+        self.compactor = None
+
+        self.applied = readApplied(filePath)
+        self.lastId = self.applied
+        self.pending = 0
+        for (i, _) in readEntries(self.path):
+            self.lastId = max(self.lastId, i)
+            if i > self.applied:
+                self.pending += 1
+
+        # Cut off anything torn, so new entries don't land after garbage.
+        self._rewrite(self.applied)
+        self.fi = open(self.path, 'ab')
+
+    def _rewrite(self, upTo):
+        "Rewrites the journal with only the entries after upTo."
+        (fd, tmpPath) = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, 'wb') as out:
+            for (i, message) in list(readEntries(self.path)):
+                if i > upTo:
+                    out.write(self._frame(i, message))
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmpPath, self.path)
+
+    @staticmethod
+    def _frame(entryId, message):
+        data = message.encode()
+        return b'#%d %d\n' % (entryId, len(data)) + data + b'\n'
+
+    def entries(self):
+        "Yields the (id, message) entries the inventory file doesn't have yet."
+        for (i, message) in readEntries(self.path):
+            if i > self.applied:
+                yield (i, message)
+
+    def replay(self, factories, records):
+        """Runs every entry the inventory file doesn't have yet against records.
+Returns how many there were."""
+        count = 0
+        for (_, message) in self.entries():
+            protocol.interpretMessage(message, factories, records)
+            count += 1
+        return count
+
+    def record(self, message):
+        "Appends message to the journal. Meant to be a protocol listener."
+        with self.lock:
+            self.lastId += 1
+            self.fi.write(Journal._frame(self.lastId, message))
+            self.fi.flush()
+            os.fsync(self.fi.fileno())
+            self.pending += 1
+
+    def compact(self, records, commit, background = True):
+        """Folds the journal into the inventory file, using commit(filePath,
+records, header) to write it. The records get copied here, so the caller can
+keep changing them while the write happens on another thread."""
+        self.wait()
+        with self.lock:
+            upTo = self.lastId
+            self.pending = 0
+        snapshot = [(k, r.copy()) for (k, r) in records]
+
+        def run():
+            commit(self.filePath, snapshot, "#journal " + str(upTo))
+            with self.lock:
+                self.applied = upTo
+                self.fi.close()
+                self._rewrite(upTo)
+                self.fi = open(self.path, 'ab')
+
+        if background:
+            self.compactor = threading.Thread(target = run)
+            self.compactor.start()
+        else:
+            run()
+
+    def maybeCompact(self, records, commit):
+        "Starts a background compaction once enough entries have piled up."
+        if self.pending >= self.compactAfter and \
+                (self.compactor is None or not self.compactor.is_alive()):
+            self.compact(records, commit)
+
+    def wait(self):
+        "Waits for a running compaction to finish."
+        if self.compactor is not None:
+            self.compactor.join()
+            self.compactor = None
+
+    def close(self):
+        self.wait()
+        self.fi.close()
+
+    def discard(self):
+        "Removes the journal, once something else wrote everything out."
+        self.close()
+        os.unlink(self.path)
+
+class JournalTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filePath = os.path.join(self.dir, "parts")
+        with open(self.filePath, 'w') as fi:
+            fi.write('Part: id="1" description="a" footprint="f" quantity="1"\n')
+        self.facts = {"Part": record.toFactory(("id", str), ("description", str),
+                                               ("footprint", str), ("quantity", int)).freeze()}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def load(self):
+        with open(self.filePath) as fi:
+            return store.RecordStore(self.facts, parser.parseStream(fi, self.facts))
+
+    @staticmethod
+    def commit(filePath, records, header):
+        "What compact writes with: the header line, then a line per record."
+        with open(filePath, 'w') as fi:
+            fi.write(header + '\n')
+            fi.writelines(k + ": " + str(r) + '\n' for (k, r) in records)
+
+    def ids(self, records):
+        return [r.getAttribute("id") for (_, r) in records]
+
+    def send(self, records, journ, message):
+        protocol.addListener(journ.record)
+        try:
+            return protocol.interpretMessage(message, self.facts, records)
+        finally:
+            protocol.removeListener(journ.record)
+
+    def test_replay(self):
+        journ = Journal(self.filePath)
+        recs = self.load()
+        self.send(recs, journ, 'add\nPart: id="2" description="b" footprint="f" quantity="2"')
+        self.send(recs, journ, 'list')
+        self.send(recs, journ, 'rm\nPart: id="1"')
+        self.send(recs, journ, 'rm\nPart: lolol="lololol"')
+        self.send(recs, journ, 'set\nPart: id="2"\nPart: quantity="5"')
+        journ.close()
+
+        # Only the mutating messages that worked got written.
+        self.assertEqual([i for (i, _) in readEntries(journalPath(self.filePath))], [1, 2, 3])
+
+        # "Crash": the inventory file never got written, the journal did.
+        recs = self.load()
+        journ = Journal(self.filePath)
+        self.assertEqual(journ.replay(self.facts, recs), 3)
+        self.assertEqual(self.ids(recs), ["2"])
+        self.assertEqual(list(recs)[0][1].getAttribute("quantity"), 5)
+
+        # A torn write at the end is dropped.
+        journ.close()
+        with open(journalPath(self.filePath), 'ab') as fi:
+            fi.write(b'#4 100\nadd\nPart: id="3"')
+        journ = Journal(self.filePath)
+        self.assertEqual(len(list(journ.entries())), 3)
+        self.send(recs, journ, 'add\nPart: id="4" description="b" footprint="f" quantity="2"')
+        self.assertEqual([i for (i, _) in journ.entries()], [1, 2, 3, 4])
+        journ.close()
+
+    def test_compact(self):
+        journ = Journal(self.filePath, compactAfter = 2)
+        recs = self.load()
+        self.send(recs, journ, 'add\nPart: id="2" description="b" footprint="f" quantity="2"')
+        journ.maybeCompact(recs, self.commit)
+        self.assertIsNone(journ.compactor)
+        self.send(recs, journ, 'rm\nPart: id="1"')
+        journ.maybeCompact(recs, self.commit)
+        self.send(recs, journ, 'add\nPart: id="3" description="c" footprint="f" quantity="3"')
+        journ.close()
+
+        self.assertEqual(readApplied(self.filePath), 2)
+        self.assertEqual(self.ids(self.load()), ["2"])
+        self.assertEqual([i for (i, _) in readEntries(journalPath(self.filePath))], [3])
+
+        # Replaying applies just what the file doesn't have, even if the
+        # journal still had the folded entries (a crash mid-compaction).
+        with open(journalPath(self.filePath), 'wb') as fi:
+            fi.write(Journal._frame(1, 'add\nPart: id="2" description="b" footprint="f" quantity="2"'))
+            fi.write(Journal._frame(2, 'rm\nPart: id="1"'))
+            fi.write(Journal._frame(3, 'add\nPart: id="3" description="c" footprint="f" quantity="3"'))
+        recs = self.load()
+        journ = Journal(self.filePath)
+        self.assertEqual(journ.replay(self.facts, recs), 1)
+        self.assertEqual(self.ids(recs), ["2", "3"])
+        self.assertEqual(journ.lastId, 3)
+
+        journ.compact(recs, self.commit, background = False)
+        journ.discard()
+        self.assertFalse(os.path.exists(journalPath(self.filePath)))
+        self.assertEqual(self.ids(self.load()), ["2", "3"])
+
+if __name__ == '__main__':
+    unittest.main()
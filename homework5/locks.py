@@ -0,0 +1,191 @@
+#!/usr/bin/python
+
+import contextlib
+import threading
+import time
+import unittest
+
+#
+# RWLock class:
+# A reader/writer lock for sharing one set of records between threads: any
+# number of readers at once, or one writer. Neither side can starve the other:
+# once a writer is waiting, new readers wait behind it, and when a writer is
+# done, the readers that waited through it all get in before the next writer.
+# The thread holding the write side can take either side again (so a writer can
+# run requests that lock for themselves). With sharedReads off, readers are
+# exclusive too, for stores that change themselves when read.
+#
+class RWLock:
+    def __init__(self, sharedReads = True):
+        self.cond = threading.Condition(threading.Lock())
+        self.sharedReads = sharedReads
+        self.readers = 0
+        self.writer = None
+        self.depth = 0
+        self.waiting = 0
+        self.blocked = 0
+        self.admit = 0
+        self.writes = 0
+
+    def _ownsWrite(self):
+        return self.writer == threading.get_ident()
+
+    def acquireRead(self):
+        if not self.sharedReads:
+            return self.acquireWrite()
+        with self.cond:
+            if self._ownsWrite():
+                self.depth += 1
+                return
+            if self.writer is None and self.waiting == 0:
+                self.readers += 1
+                return
+
+            seen = self.writes
+            self.blocked += 1
+            try:
+                self.cond.wait_for(lambda: self.writer is None and
+                                   (self.waiting == 0 or self.writes != seen))
+            finally:
+                self.blocked -= 1
+                if self.writes != seen and self.admit > 0:
+                    self.admit -= 1
+                    if self.admit == 0:
+                        self.cond.notify_all()
+            self.readers += 1
+
+    def releaseRead(self):
+        if not self.sharedReads:
+            return self.releaseWrite()
+        with self.cond:
+            if self._ownsWrite():
+                self.depth -= 1
+                return
+            self.readers -= 1
+            if self.readers == 0:
+                self.cond.notify_all()
+
+    def acquireWrite(self):
+        with self.cond:
+            if self._ownsWrite():
+                self.depth += 1
+                return
+            self.waiting += 1
+            try:
+                self.cond.wait_for(lambda: self.writer is None and self.readers == 0
+                                           and self.admit == 0)
+            finally:
+                self.waiting -= 1
+            self.writer = threading.get_ident()
+            self.depth = 1
+
+    def releaseWrite(self):
+        with self.cond:
+            if not self._ownsWrite():
+                raise RuntimeError("Releasing a write lock this thread doesn't hold")
+            self.depth -= 1
+            if self.depth == 0:
+                self.writer = None
+                self.writes += 1
+                self.admit = self.blocked
+                self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def reading(self):
+        self.acquireRead()
+        try:
+            yield
+        finally:
+            self.releaseRead()
+
+    @contextlib.contextmanager
+    def writing(self):
+        self.acquireWrite()
+        try:
+            yield
+        finally:
+            self.releaseWrite()
+
+class RWLockTests(unittest.TestCase):
+    def test_readers(self):
+        lock = RWLock()
+        inside = threading.Barrier(3, timeout = 5)
+        def read():
+            with lock.reading():
+                # Only gets past this if all three readers are in at once.
+                inside.wait()
+        threads = [threading.Thread(target = read) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertFalse(inside.broken)
+
+    def test_writers(self):
+        lock = RWLock()
+        events = []
+        def write(n):
+            with lock.writing():
+                events.append(('in', n))
+                time.sleep(0.01)
+                events.append(('out', n))
+        def read(n):
+            with lock.reading():
+                events.append(('read', n))
+
+        threads = [threading.Thread(target = write, args = (i,)) for i in range(3)] + \
+                  [threading.Thread(target = read, args = (i,)) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # Nothing happens while a writer is in.
+        for (i, x) in enumerate(events):
+            if x[0] == 'in':
+                self.assertEqual(events[i + 1], ('out', x[1]))
+        self.assertEqual(len(events), 9)
+
+    def test_fair(self):
+        lock = RWLock()
+        events = []
+        def write():
+            with lock.writing():
+                events.append('write')
+        def read():
+            with lock.reading():
+                events.append('read')
+
+        # A reader that waited through a write gets in before the next writer.
+        lock.acquireWrite()
+        threads = [threading.Thread(target = write), threading.Thread(target = read)]
+        for t in threads:
+            t.start()
+            time.sleep(0.02)
+        lock.releaseWrite()
+        for t in threads:
+            t.join()
+        self.assertEqual(events, ['read', 'write'])
+
+    def test_reentrant(self):
+        lock = RWLock()
+        with lock.writing():
+            with lock.reading():
+                with lock.writing():
+                    pass
+            self.assertEqual(lock.depth, 1)
+        self.assertIsNone(lock.writer)
+        self.assertRaises(RuntimeError, lock.releaseWrite)
+
+        # Exclusive reads block each other.
+        lock = RWLock(sharedReads = False)
+        with lock.reading():
+            t = threading.Thread(target = lambda: lock.acquireRead())
+            t.start()
+            t.join(0.05)
+            self.assertTrue(t.is_alive())
+        t.join()
+        self.assertIsNotNone(lock.writer)
+
+if __name__ == '__main__':
+    unittest.main()
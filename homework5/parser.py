@@ -1,28 +1,48 @@
 #!/usr/bin/python
 
+import attribute
+import io
+import itertools
 import re
+import record
 import unittest
 
-def getKvPairs(line):
-    "Gets the key/value pairs back from a string. Returns as a dict."
+# Compiled once here, rather than on every line. Besides key="value", match
+# lines can compare numbers: key<"value" (and <=, >, >=) comes back as the
+# pair (key, "<value"), which is the range criteria attribute.getRange reads.
+# Anywhere else (records being added, or read from a file) that's an error.
+_kvPattern = re.compile(r'\s*(?:(?P<name>\w+)\s*(?P<op><=|>=|<|>|=)\s*"(?P<value>[^"]+)"'
+                        r'|(?P<tag>\w+)\s+(?=[^=<>]))\s*')
+_namePattern = re.compile(r'\s*(\w+):')
 
-    if line is None or len(line) == 0:
+class _Comparison(str):
+    """A key<"value" criteria, so it can be told from key="<value" once the
+attribute's type is known. Records cast it back to a plain str."""
+
+def _kvPairsAt(line, pos = 0, forMatch = False):
+    "getKvPairs, for the part of line from pos on."
+    fields = _kvPattern.findall(line, pos)
+
+    if len(fields) == 0:
         return None
 
-    reg = re.compile(r'\s*(?:(?P<name>\w+)\s*=\s*"(?P<value>[^"]+)"|(?P<tag>\w+)\s+(?=[^=]))\s*')
-    fields = reg.findall(line)
+    if not forMatch:
+        for (name, op, value, tag) in fields:
+            if op not in ('=', ''):
+                raise ValueError('{0}{1}"{2}" is a comparison, which only works when matching '
+                                 'records'.format(name, op, value))
+
+    return [(tag,) if tag != '' else (name, value) if op == '=' else
+            (name, _Comparison(op + value)) for (name, op, value, tag) in fields]
+
+def getKvPairs(line, forMatch = False):
+    """Gets the key/value pairs back from a string. Returns as a dict. Comparisons
+(key<"value") are only allowed forMatch."""
 
-    if fields is None or len(fields) == 0:
+    if line is None or len(line) == 0:
         return None
 
-    result = []
-    for (name, value, tag) in fields:
-        if tag == '':
-            result.append((name,value))
-        else:
-            result.append((tag,))
-    
-    return result
+    return _kvPairsAt(line, forMatch = forMatch)
 
 def processTotal(block):
     "Does an initial pass over block. Processes/sanitizes block data."
@@ -33,57 +53,77 @@ def extractRecordName(block):
     if block is None or len(block) == 0:
         return None
 
-    reg = re.compile(r'\s*(\w+):')
-
-    match = reg.match(block)
+    match = _namePattern.match(block)
 
     if match is None:
         return None
 
-    result = match.group(1)
-    remain = None
-
-    at = match.span()[1]
-
-    if len(block) > at + 1:
-        remain = block[at:]
-
-    return (result, remain)
+    at = match.end()
+    return (match.group(1), block[at:] if len(block) > at + 1 else None)
 
 def isModifier(mod):
     return re.match(r'\s*\w+\s*=')
 
-def processLine(line):
-    recRes = extractRecordName(line)
+def processLine(line, forMatch = False):
+    """Splits line into ('Record', (name, kv pairs)) or ('Modifier', line). Same
+as extractRecordName + getKvPairs, but without copying the rest of the line."""
+    match = _namePattern.match(line)
 
-    if recRes is None:
+    if match is None:
         return ('Modifier', line)
-    
-    return ('Record', (recRes[0], getKvPairs(recRes[1])))
 
+    at = match.end()
+    kv = _kvPairsAt(line, at, forMatch) if len(line) > at + 1 else None
+    return ('Record', (match.group(1), kv))
+
+def iterLines(lines):
+    """Joins backslash-continued lines from lines (any iterable of lines, like an
+open file), and yields each stripped, non-empty line as it completes."""
+    pending = []
+    for line in lines:
+        if line.endswith('\\\n'):
+            pending.append(line[:-2])
+            continue
+        if len(pending) > 0:
+            pending.append(line)
+            line = ''.join(pending)
+            pending = []
+        line = line.lstrip().rstrip()
+        if len(line) > 0:
+            yield line
+
+    line = ''.join(pending).lstrip().rstrip()
+    if len(line) > 0:
+        yield line
+
+def _toRecord(recName, recLine, recordFactories, forMatch):
+    fact = recordFactories[recName]
+    if forMatch:
+        for i in recLine or []:
+            attr = fact.attrs.get(i[0]) if len(i) == 2 else None
+            if attr is None:
+                continue
+            try:
+                attribute.checkCriteria(attr.getType(), str(i[1]), type(i[1]) is _Comparison)
+            except ValueError as e:
+                raise ValueError('Can\'t match {0} against "{1}": {2}'.format(i[0], i[1], e))
+        return fact.generateMatchRecord(recLine)
+    return fact.generateRecord(recLine)
 
 def parseTextBlock(block, recordFactories, forMatch = False):
     if block is None or len(block) == 0 or recordFactories is None:
         return None
     
-    block = processTotal(block)
-    blocks = block.split('\n')
-    blocks = map(lambda s: s.lstrip().rstrip(), blocks)
-    blocks = filter(lambda x: len(x) > 0, blocks)
+    blocks = iterLines(io.StringIO(block))
 
     result = {'Record': [], 'Modifier': []}
     
     for i in blocks:
-        (type_, res) = processLine(i)
+        (type_, res) = processLine(i, forMatch)
         if type_ == 'Record':
             (recName, recLine) = res
             if recName in recordFactories.keys():
-                fact = recordFactories[recName]
-                if forMatch:
-                    res = fact.generateMatchRecord(recLine)
-                else:
-                    res = fact.generateRecord(recLine)
-                res = (recName, res)
+                res = (recName, _toRecord(recName, recLine, recordFactories, forMatch))
         if res is not None:
             result[type_].append(res)
 
@@ -92,6 +132,54 @@ def parseTextBlock(block, recordFactories, forMatch = False):
 
     return result
 
+def buildRecords(pairs, recordFactories):
+    """Builds a record for every (name, kv pairs) in pairs, with one
+generateRecords per record type, so each attribute's values get cast a column
+at a time. Returns (entries, failures): the (name, Record) entries, and the
+(row, key, value) of values that couldn't be cast, in row order. Rows with bad
+values get no entry."""
+    byName = {}
+    for (row, (name, kv)) in enumerate(pairs):
+        (rows, kvs) = byName.setdefault(name, ([], []))
+        rows.append(row)
+        kvs.append(kv)
+
+    built = [None] * len(pairs)
+    failures = []
+    for (name, (rows, kvs)) in byName.items():
+        (recs, bad) = recordFactories[name].generateRecords(kvs)
+        for (row, rec) in zip(rows, recs):
+            built[row] = rec
+        failures += [(rows[row], key, value) for (row, key, value) in bad]
+
+    failures.sort(key = lambda x: x[0])
+    return ([(name, rec) for ((name, _), rec) in zip(pairs, built) if rec is not None],
+            failures)
+
+def parseStream(lines, recordFactories, forMatch = False):
+    """Like parseTextBlock, but pulls from lines (e.g. an open file) as it goes and
+yields each (name, Record) as soon as it's parsed, so nothing but the current
+line is held in memory. Modifier lines are skipped; records that none of
+recordFactories can build are an error, and so are bad values (the error says
+which record, counting from 1)."""
+    if lines is None or recordFactories is None:
+        return
+
+    count = 0
+    for i in iterLines(lines):
+        (type_, res) = processLine(i, forMatch)
+        if type_ != 'Record':
+            continue
+        (recName, recLine) = res
+        if recName not in recordFactories:
+            raise ValueError("Unknown record type " + recName)
+        count += 1
+        try:
+            rec = _toRecord(recName, recLine, recordFactories, forMatch)
+        except ValueError as e:
+            raise ValueError("Record {0}: {1}".format(count, e))
+        yield (recName, rec)
+
 class ParserTests(unittest.TestCase):
     def test_process(self):
         x = "hello\nworld\nwhat's\nup"
@@ -161,6 +249,18 @@ class ParserTests(unittest.TestCase):
         self.assertEqual(kv[1][0], "world")
         self.assertEqual(kv[1][1], "hello")
 
+    def test_kvRanges(self):
+        self.assertEqual(getKvPairs('quantity<"10" id="1*"', forMatch = True),
+                         [("quantity", "<10"), ("id", "1*")])
+        self.assertEqual(getKvPairs('quantity >= "10"', True), [("quantity", ">=10")])
+        self.assertEqual(getKvPairs('quantity="5..20"'), [("quantity", "5..20")])
+        self.assertIsNone(getKvPairs('quantity<10', True))
+
+        # Comparisons aren't values.
+        self.assertRaises(ValueError, getKvPairs, 'id="1" quantity<"10"')
+        self.assertRaises(ValueError, processLine, 'Part: id<"5"')
+        self.assertEqual(processLine('Part: id<"5"', True), ('Record', ("Part", [("id", "<5")])))
+
     def test_parseTextBlock(self):
         self.assertIsNone(parseTextBlock("", None))
         self.assertIsNone(parseTextBlock("str", None))
@@ -185,6 +285,98 @@ class ParserTests(unittest.TestCase):
             for i in recres:
                 self.assertIn(i, parsed["Record"])
 
+    def test_iterLines(self):
+        lines = ["hel\\\n", "lo\n", "  \n", "\t world  \n", "what\\\n", "\\\n", "'s\n", "up\\\n"]
+        self.assertEqual(list(iterLines(lines)), ["hello", "world", "what's", "up"])
+        self.assertEqual(list(iterLines(io.StringIO("a\n\nb"))), ["a", "b"])
+        self.assertEqual(list(iterLines([])), [])
+
+        # Has to agree with processTotal + split.
+        y = "hel\\\nlo\nworld\nwhat\\\n's\nup"
+        self.assertEqual(list(iterLines(io.StringIO(y))), processTotal(y).split('\n'))
+
+    def test_parseStream(self):
+        rf = record.RecordFactory()
+        rf.addAttribute("id", attribute.Attribute())
+        facts = {"Part": rf}
+
+        self.assertEqual(list(parseStream(None, facts)), [])
+        self.assertEqual(list(parseStream(io.StringIO(""), facts)), [])
+
+        txt = 'Part: id="1"\nsort Part by id\n\nPart: \\\n id="2"\n'
+        stream = parseStream(io.StringIO(txt), facts)
+        (name, rec) = next(stream)
+        self.assertEqual(name, "Part")
+        self.assertEqual(rec.getAttribute("id"), "1")
+        (name, rec) = next(stream)
+        self.assertEqual(rec.getAttribute("id"), "2")
+        self.assertRaises(StopIteration, next, stream)
+
+        block = parseTextBlock(txt, facts)
+        self.assertEqual([(k, str(r)) for (k, r) in block["Record"]],
+                         [(k, str(r)) for (k, r) in parseStream(io.StringIO(txt), facts)])
+
+        stream = parseStream(io.StringIO('Part: id="1"\nThing: id="2"\n'), facts)
+        next(stream)
+        self.assertRaises(ValueError, next, stream)
+
+        # Bad values get pointed out by record number, after what came before.
+        at = attribute.Attribute()
+        at.setType(int)
+        rf.addAttribute("quantity", at)
+        lines = ['Part: id="{0}" quantity="{1}"'.format(i, "x" if i in (7, 9) else i)
+                 for i in range(12)]
+        stream = parseStream(lines, facts)
+        self.assertEqual([r.getAttribute("quantity") for (_, r) in itertools.islice(stream, 7)],
+                         list(range(7)))
+        with self.assertRaisesRegex(ValueError, r'^Record 8: Invalid key or value.*\(quantity'):
+            next(stream)
+
+        # So are comparisons, except in match records.
+        self.assertRaises(ValueError, list, parseStream(['Part: id<"5"'], facts))
+        self.assertRaises(ValueError, parseTextBlock, 'Part: id<"5"', facts)
+        (_, rec) = next(parseStream(['Part: quantity<"5"'], facts, forMatch = True))
+        self.assertEqual(rec.getAttribute("quantity"), "<5")
+        self.assertIs(type(rec.getAttribute("quantity")), str)
+
+        # ... and then only ones that work: on numbers, with bounds of their type.
+        # Quoted, "<5" is just text to match a str against.
+        self.assertRaisesRegex(ValueError, r'^Can\'t match id against "<5": comparisons only work '
+                               r'on numbers', parseTextBlock, 'Part: id<"5"', facts, True)
+        (rec,) = parseTextBlock('Part: id="<5"', facts, True)["Record"]
+        self.assertEqual(rec[1].getAttribute("id"), "<5")
+        self.assertRaisesRegex(ValueError, r'^Record 1: Can\'t match quantity against "<5.5": that '
+                               r'isn\'t a range of ints', list,
+                               parseStream(['Part: quantity<"5.5"'], facts, forMatch = True))
+        for bad in ['quantity="<5.5"', 'quantity="1..x"', 'quantity>="lots"']:
+            self.assertRaises(ValueError, parseTextBlock, 'Part: ' + bad, facts, True)
+
+    def test_buildRecords(self):
+        facts = {}
+        for (name, type_) in [("Part", int), ("Bin", str)]:
+            rf = record.RecordFactory()
+            at = attribute.Attribute()
+            at.setType(type_)
+            rf.addAttribute("id", at)
+            facts[name] = rf
+
+        pairs = [processLine(x)[1] for x in ['Part: id="1"', 'Bin: id="a"', 'Part: id="b"',
+                                             'Bin: id="2"', 'Part: id="c"', 'Part: id="3"']]
+        (entries, failures) = buildRecords(pairs, facts)
+        self.assertEqual([(k, r.getAttribute("id")) for (k, r) in entries],
+                         [("Part", 1), ("Bin", "a"), ("Bin", "2"), ("Part", 3)])
+        self.assertEqual(failures, [(2, "id", "b"), (4, "id", "c")])
+        self.assertEqual(buildRecords([], facts), ([], []))
+
+    def test_processLine(self):
+        # Has to give the same answers as the functions it stands in for.
+        for line in ['Part: id="1" quantity="2"', 'Part:', 'Part:x', 'Part: x ',
+                     ' Part : id="1"', 'sort Part by id', 'a: b: c="d" e', 'a: "x"=y']:
+            recRes = extractRecordName(line)
+            if recRes is None:
+                self.assertEqual(processLine(line), ('Modifier', line))
+            else:
+                self.assertEqual(processLine(line), ('Record', (recRes[0], getKvPairs(recRes[1]))))
+
 if __name__ == '__main__':
-    import record
     unittest.main()
@@ -1,18 +1,45 @@
 #!/usr/bin/python
 
 import attribute
-import copy
+import collections
+import columns
+import contextlib
+import heapq
+import io
+import itertools
 import parser
 import re
 import record
+import store
+import threading
+import unittest
+import weakref
 
 requests = {}
+mutating = set()
+listeners = []
 
-def addRequest(reqName, method):
+def addRequest(reqName, method, mutates = False):
+    """Registers method to handle reqName requests. mutates says whether the
+request changes the records, so listeners hear about it."""
     if reqName is None or method is None or not callable(method):
         raise ValueError("reqName can't be none, method must be callable")
     global requests
     requests[reqName.lower()] = method
+    if mutates:
+        mutating.add(reqName.lower())
+    else:
+        mutating.discard(reqName.lower())
+
+def addListener(method):
+    "method(message) gets called with every mutating message that succeeded."
+    if method is None or not callable(method):
+        raise ValueError("method must be callable")
+    listeners.append(method)
+
+def removeListener(method):
+    if method in listeners:
+        listeners.remove(method)
 
 def _toRecords(recStr, factories, isMatch = False, justRecords = True):
     if recStr is None:
@@ -33,118 +60,270 @@ def _toRecords(recStr, factories, isMatch = False, justRecords = True):
 def _findEntries(match, factories, records, defaultAll = False):
     matchRecs = _toRecords(match, factories, True)
 
-    result = []
-
     if matchRecs is None or len(matchRecs) == 0:
         if defaultAll:
-            return records
+            return list(records)
         else:
             return None
 
-    for i in records:
-        for x in matchRecs:
-            if i.meetsCriteria(x):
-                result.append(i)
+    return records.match(matchRecs)
+
+def _sortKey(fields, byType = False):
+    """Returns a key function that turns a record into one tuple covering all of
+fields, most significant first. Each field adds (is None, value) so that Nones
+sort last rather than failing to compare; byType also adds the value's type
+name, for fields where values of different types have to be compared."""
+    positions = {}
+    def key(r):
+        at = positions.get(id(r.schema))
+        if at is None:
+            at = positions[id(r.schema)] = [r.schema.positions[f] for f in fields]
+        values = r.values
+        result = []
+        for i in at:
+            v = values[i]
+            result.append(v is None)
+            if byType:
+                result.append(type(v).__name__)
+            result.append(v)
+        return tuple(result)
+    return key
+
+def _sortRecords(recs, fields, limit = None):
+    """Sorts recs by fields in one pass. If only the first limit records are
+wanted, they get picked out with a heap instead of sorting everything. With
+numpy around, lots of records get sorted column-wise instead."""
+    if columns.available() and len(recs) >= columns.SORT_MIN:
+        order = columns.sortOrder([[r.getAttribute(f) for r in recs] for f in fields])
+        if order is not None:
+            return [recs[i] for i in order[:limit]]
+
+    def sort(key):
+        if limit is not None and limit < len(recs):
+            return heapq.nsmallest(limit, recs, key = key)
+        return sorted(recs, key = key)
 
-    return result
+    try:
+        return sort(_sortKey(fields))
+    except TypeError:
+        return sort(_sortKey(fields, byType = True))
+
+_sortModifier = re.compile(r'\s*sort\s+(?P<Type>\w+)\s+by\s+(?P<Fields>.*)')
+_pageModifier = re.compile(r'\s*(?P<Which>limit|offset)\s+(?P<Count>\d+)\s*$')
+
+def _formatEntries(listed):
+    "Yields the output line of every (name, Record) in listed."
+    for (k, r) in listed:
+        yield k + ": " + str(r) + "\n"
 
 def _listEntries(match, factories, records):
+    """Lists the records meeting the criteria in match (or all of them). Modifiers:
+  sort <Record> by <attr>[, <attr>...]
+  offset <N>    skip the first N records
+  limit <N>     list at most N records"""
     try:
-        listed = _findEntries(match, factories, records, defaultAll = True)
+        parsed = _toRecords(match, factories, True, justRecords = False)
     except Exception as e:
         return (False, str(e))
 
-    if listed is None or len(listed) == 0:
-        return (True, None)
+    if parsed is None:
+        parsed = {'Record': [], 'Modifier': []}
+
+    sorts = []
+    page = {'offset': 0, 'limit': None}
+    for i in parsed['Modifier']:
+        sortresult = _sortModifier.match(i)
+        pageresult = _pageModifier.match(i)
+        if pageresult is not None:
+            page[pageresult.group('Which')] = int(pageresult.group('Count'))
+        elif sortresult is None:
+            return (False, "Could not interpret modifier '" + i + "'")
+        else:
+            results = sortresult.groups()
+            if results[0] not in factories:
+                return (False, results[0] + ' is not a valid record')
+
+            sortby = []
+            schema = factories[results[0]].getSchema()
+            for a in results[1].split(','):
+                a = a.lstrip().rstrip()
+                if a not in schema.positions:
+                    return (False, 'asking to sort by invalid attribute ' + a + ' from ' + results[0])
+                sortby.append(a)
+            sorts.append((results[0], sortby))
+
+    (offset, limit) = (page['offset'], page['limit'])
+    end = None if limit is None else offset + limit
 
-    allList = parser.parseTextBlock(match, factories, False)
-    
-    # Sorting
-    if allList is not None and 'Modifier' in allList and len(allList['Modifier']) > 0:
-        modifiers = allList['Modifier']
-        fields = None
-        for i in modifiers:
-            sortresult = re.match(r'\s*sort\s+(?P<Type>\w+)\s+by\s+(?P<Fields>.*)', i)
-            if sortresult is None:
-                return (False, "Could not interpret modifier '" + i + "'")
-            else:
-                results = sortresult.groups()
-                if results[0] not in factories:
-                    return (False, results[0] + ' is not a valid record')
-
-                unsorted_records = [i[1] for i in listed if i[0] == results[0]]
-                listed = [x for x in listed if x[0] != results[0]]
-
-                if len(unsorted_records) == 0:
-                    continue
-
-                sortby = []
-                
-                for a in results[1].split(','):
-                    a = a.lstrip().rstrip()
-                    if not unsorted_records[0].hasAttribute(a):
-                        return (False, 'asking to sort by invalid attribute ' + a + ' from ' + results[0])
-                    sortby.append(a)
-                
-                # Now sort from least to most important (most important first)
-                while len(sortby) > 0:
-                    x = sortby.pop()
-                    unsorted_records = sorted(unsorted_records, key = lambda z: z.getAttribute(x))
-
-                listed += [(results[0], x) for x in unsorted_records]
-
-    # Making string of [potentially sorted] keys...
-    result = ""
-    for k, r in listed:
-        result += "{0}: {1}\n".format(k, str(r))
-
-    return (True, result)
+    try:
+        if len(parsed['Record']) > 0:
+            listed = records.match(parsed['Record'])
+        elif len(sorts) == 0:
+            # Nothing to sort, so only walk the records as far as the page goes.
+            listed = records.iterEntries()
+        else:
+            listed = list(records)
+    except Exception as e:
+        return (False, str(e))
 
-def _addEntries(entry, factories, records):
-    "Default add entries method"
+    # Each sort moves its records to the end, in order. Only the last sort's
+    # records can be cut off by the limit, so just that many get sorted.
+    for (n, (name, sortby)) in enumerate(sorts):
+        unsorted_records = [r for (k, r) in listed if k == name]
+        listed = [x for x in listed if x[0] != name]
+        wanted = None
+        if end is not None and n == len(sorts) - 1:
+            wanted = max(0, end - len(listed))
+        listed += [(name, x) for x in _sortRecords(unsorted_records, sortby, wanted)]
+
+    result = "".join(_formatEntries(itertools.islice(listed, offset, end)))
+    return (True, result if len(result) > 0 else None)
+
+#
+# ResultCache class:
+# Remembers what list requests returned, per store, so asking the same thing
+# again before anything has changed costs a dict lookup. A store's generation
+# goes up with every add, remove and update (see store.RecordStore), and results
+# from an older generation are never handed back. Stores without a generation
+# (like MappedRecordStore) don't get cached. Each store keeps its maxSize most
+# recently used results.
+#
+class CacheInfo(collections.namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])):
+    @property
+    def hitRate(self):
+        total = self.hits + self.misses
+        return 0.0 if total == 0 else self.hits / float(total)
+
+class ResultCache:
+    def __init__(self, maxSize = 128):
+        self.maxSize = maxSize
+        self.stores = weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, records, key, method):
+        """Returns what method() returns for key against records, from the cache
+if records hasn't changed since it was last asked."""
+        generation = getattr(records, 'generation', None)
+        if generation is None or self.maxSize <= 0:
+            return method()
+
+        with self.lock:
+            cached = self.stores.get(records)
+            if cached is not None and cached[0] == generation and key in cached[1]:
+                cached[1].move_to_end(key)
+                self.hits += 1
+                return cached[1][key]
+            self.misses += 1
+
+        result = method()
+
+        with self.lock:
+            # Don't keep anything that might've been worked out mid-change.
+            if records.generation != generation:
+                return result
+            cached = self.stores.get(records)
+            if cached is None or cached[0] != generation:
+                cached = self.stores[records] = (generation, collections.OrderedDict())
+            cached[1][key] = result
+            while len(cached[1]) > self.maxSize:
+                cached[1].popitem(last = False)
+        return result
+
+    def info(self):
+        "Returns the CacheInfo(hits, misses, maxsize, currsize) of the cache."
+        with self.lock:
+            size = sum(len(x[1]) for x in self.stores.values())
+            return CacheInfo(self.hits, self.misses, self.maxSize, size)
+
+    def clear(self):
+        with self.lock:
+            self.stores.clear()
+            self.hits = 0
+            self.misses = 0
+
+listCache = ResultCache()
+
+def _cachedListEntries(match, factories, records):
+    """_listEntries, through listCache. The request is keyed on its lines the
+way the parser sees them, so whitespace and blank lines don't matter."""
+    key = (id(factories), tuple(parser.iterLines(io.StringIO(match or ""))))
+    return listCache.lookup(records, key, lambda: _listEntries(match, factories, records))
+
+def _newEntries(entry, factories):
+    """Parses the records an add request wants added. Returns (True, the valid
+records) or (False, an error message)."""
+    lines = [] if entry is None else list(parser.iterLines(io.StringIO(entry)))
+    if len(lines) == 0:
+        return (False, "No records to add.")
+
+    # Every attribute's values get cast together, and the bad ones get named.
+    try:
+        pairs = [res for (type_, res) in map(parser.processLine, lines) if type_ == 'Record']
+    except ValueError as e:
+        return (False, str(e))
     try:
-        recs = _toRecords(entry, factories)
+        (recs, failures) = parser.buildRecords(pairs, factories)
     except:
         return (False, "One or more records had invalid data.")
 
+    if len(failures) > 0:
+        return (False, "One or more records had invalid data: " + ", ".join(
+                'record {0} {1}="{2}"'.format(row + 1, key, value)
+                for (row, key, value) in failures))
+
     validRecs = [(k, i) for (k, i) in recs if i.isValid()]
 
     if len(validRecs) != len(recs):
-        print("WARNING: " + str(recs - validRecs) + " records were incomplete")
+        print("WARNING: " + str(len(recs) - len(validRecs)) + " records were incomplete")
+
+    return (True, validRecs)
+
+def _addEntries(entry, factories, records):
+    "Default add entries method"
+    (res, recs) = _newEntries(entry, factories)
+    if res is False:
+        return (False, recs)
 
     if records is None:
         records = []
 
-    records += validRecs
+    records += recs
     return (True, None)
 
 def _delEntries(entry, factories, records):
     "Default delete entries method"
     try:
         match = _toRecords(entry, factories, True)
+        if match is None:
+            return (False, None)
+        records.removeMany(records.match(match))
     except Exception as e:
         return (False, str(e))
-    if match is None:
-        return (False, None)
-    
-    idx = 0
-    # Can't iterate through a list while modifying it, so we make a shallow
-    # copy of it and then iterate through the copy.
-    trecs = copy.copy(records)
-    for (k, i) in trecs:
-        # Getting matches with the same type as the current record.
-        pertinent = [z for (k0, z) in match if k0 == k]
-        for m in pertinent:
-            if i.meetsCriteria(m):
-                del records[idx]
-                idx -= 1
-                break
-        idx += 1
 
     return (True, None)
 
+def _setValues(setRec, schema):
+    """Casts the values setRec (a match record, so all strs) sets to the types in
+schema, once for however many records they go on. Returns ([(name, value)],
+[(name, value) that couldn't be cast])."""
+    values = []
+    failed = []
+    for (k, v) in setRec.items():
+        if v is None:
+            continue
+        (success, value) = attribute.castValue(schema.slots[k][1], v)
+        if success:
+            values.append((k, value))
+        else:
+            failed.append((k, v))
+    return (values, failed)
+
 def _updateEntries(entry, factories, records):
-    updatesFailed = False
+    """Default update method. The message is pairs of lines: a match, then the
+values to set on everything it matches. Returns nothing if every value got
+set, and otherwise a summary of what did and what couldn't be."""
     try:
         match = _toRecords(entry, factories, True)
     except Exception as e:
@@ -153,7 +332,16 @@ def _updateEntries(entry, factories, records):
     if match is None:
         return (False, "Couldn't find match records")
 
-    msg = ""
+    # Every other record line is values to set, where comparisons don't belong.
+    lines = [x for x in parser.iterLines(io.StringIO(entry))
+             if parser.processLine(x, True)[0] == 'Record']
+    try:
+        for line in lines[1::2]:
+            parser.processLine(line)
+    except ValueError as e:
+        return (False, str(e))
+
+    notes = []
 
     # Pairing everything up into match-set pairs
     paired = []
@@ -161,37 +349,30 @@ def _updateEntries(entry, factories, records):
         if len(match) > i+1:
             if match[i][0] != match[i+1][0]:
                 return (False, "Can't update one record to another.")
+            if match[i][0] not in factories:
+                return (False, "Unknown record type " + match[i][0])
             paired.append((match[i], match[i+1]))
         else:
-            msg = "Discarded matcher for update."
+            notes.append("Discarded matcher for update.")
 
     if len(paired) == 0:
         return (False, None)
-    
-    for (mt,st) in paired:
-        m = mt[1]
-        s = st[1]
-        mset = [z[1] for z in records if z[1].meetsCriteria(m)]
-        for i in mset:
-            for (k,v) in [z for z in s.attributes.items() if not z[1].isNull()]:
-                linemsg = ""
-                try:
-                    i.setAttribute(k, v.asNatural())
-                    linemsg = "Update of field {0} to {1} succeeded".format(
-                            k, str(v.asNatural()))
-                except Exception as e:
-                    updatesFailed = True
-                    linemsg = "Failed to update field {0} to {1}.".format(
-                             k, str(v.asNatural()))
-                if len(linemsg) > 0:
-                    if len(msg) > 0:
-                        msg += '\n'
-                    msg += linemsg
-
-    if not updatesFailed:
-        msg = ""
-
-    return (True, msg if len(msg) > 0 else None)
+
+    updated = 0
+    failed = []
+    for (mt, (name, st)) in paired:
+        (values, bad) = _setValues(st, factories[name].getSchema())
+        failed += bad
+        if len(values) > 0:
+            updated += records.updateMany(records.match([mt]), values)
+
+    if len(failed) == 0:
+        return (True, None)
+
+    notes.append("Updated {0} record{1}. Couldn't set {2}.".format(
+                 updated, "" if updated == 1 else "s",
+                 ", ".join('{0} to "{1}"'.format(k, v) for (k, v) in failed)))
+    return (True, "\n".join(notes))
     
 def reportError(message, moreInfo = None):
     if moreInfo is None:
@@ -201,11 +382,9 @@ def reportError(message, moreInfo = None):
     return "error\n" + moreInfo + (message if message is not None 
                                    else "(No Message recieved)")
 
-def interpretMessage(message, factories, records):
-    global requests
-    
+def splitMessage(message):
+    "Splits message into its (lowercased) action and the rest of it."
     newline = message.find('\n')
-    act = None
     if newline == -1:
         act = message
         rmessage = None
@@ -213,19 +392,305 @@ def interpretMessage(message, factories, records):
         act = message[:newline]
         rmessage = message[newline:]
 
-    act = act.lstrip().rstrip().lower()
+    return (act.lstrip().rstrip().lower(), rmessage)
+
+def _locking(lock, act):
+    "Returns the side of lock (a locks.RWLock, or None) that act needs."
+    if lock is None:
+        return contextlib.nullcontext()
+    return lock.writing() if act in mutating else lock.reading()
+
+def interpretMessage(message, factories, records, lock = None):
+    """Runs message against records. If records are shared between threads,
+lock is the locks.RWLock they share: mutating requests (and the listeners
+hearing about them) run holding its write side, everything else its read side."""
+    global requests
+
+    (act, rmessage) = splitMessage(message)
 
     if act not in requests.keys():
         return (False, reportError(message))
 
-    return requests[act](rmessage, factories, records)
-
-addRequest('add', _addEntries)
-addRequest('append', _addEntries)
-addRequest('remove', _delEntries)
-addRequest('rm', _delEntries)
-addRequest('del', _delEntries)
-addRequest('update', _updateEntries)
-addRequest('set', _updateEntries)
-addRequest('list', _listEntries)
-addRequest('show', _listEntries)
+    with _locking(lock, act):
+        result = requests[act](rmessage, factories, records)
+        if act in mutating and result[0] is not False:
+            for i in listeners:
+                i(message)
+    return result
+
+#
+# MessageSplitter class:
+# Cuts a stream of lines up into messages the same way the interactive prompt
+# does: every line is stripped, and a message ends at two blank lines in a row.
+# Lines get fed in one at a time, so it works for anything that reads lines
+# (files, sockets, ...).
+#
+class MessageSplitter:
+    def __init__(self):
+        self.pending = []
+        self.blanks = 0
+
+    def feed(self, line):
+        "Adds line. Returns the message it completes, or None."
+        line = line.lstrip().rstrip()
+        self.pending.append(line)
+        self.blanks = self.blanks + 1 if len(line) == 0 else 0
+        if self.blanks >= 2 and len(self.pending) >= 3:
+            return self.finish()
+        return None
+
+    def finish(self):
+        "Returns whatever message is left over (or None), and starts over."
+        message = '\n'.join(self.pending).lstrip().rstrip()
+        self.pending = []
+        self.blanks = 0
+        return message if len(message) > 0 else None
+
+def iterMessages(lines):
+    "Yields each message in lines (e.g. an open file). See MessageSplitter."
+    splitter = MessageSplitter()
+    for line in lines:
+        message = splitter.feed(line)
+        if message is not None:
+            yield message
+
+    message = splitter.finish()
+    if message is not None:
+        yield message
+
+def interpretMessages(messages, factories, records, lock = None):
+    """Runs every message in messages (any iterable, like iterMessages()) and
+yields the (message, result) of each in order, as interpretMessage would. A run
+of add requests in a row gets its records inserted in one bulk add."""
+    adds = []
+    def flush():
+        done = list(adds)
+        del adds[:]
+        if len(done) == 0:
+            return
+        with contextlib.nullcontext() if lock is None else lock.writing():
+            records.extend(x for (_, recs) in done for x in recs)
+            for (message, _) in done:
+                for i in listeners:
+                    i(message)
+        for (message, _) in done:
+            yield (message, (True, None))
+
+    for message in messages:
+        (act, rmessage) = splitMessage(message)
+        if requests.get(act) is _addEntries:
+            (res, recs) = _newEntries(rmessage, factories)
+            if res is not False:
+                adds.append((message, recs))
+                continue
+            yield from flush()
+            yield (message, (False, recs))
+            continue
+
+        yield from flush()
+        yield (message, interpretMessage(message, factories, records, lock))
+
+    yield from flush()
+
+addRequest('add', _addEntries, mutates = True)
+addRequest('append', _addEntries, mutates = True)
+addRequest('remove', _delEntries, mutates = True)
+addRequest('rm', _delEntries, mutates = True)
+addRequest('del', _delEntries, mutates = True)
+addRequest('update', _updateEntries, mutates = True)
+addRequest('set', _updateEntries, mutates = True)
+addRequest('list', _cachedListEntries)
+addRequest('show', _cachedListEntries)
+
+class ProtocolTests(unittest.TestCase):
+    @staticmethod
+    def genStore():
+        facts = {"Part": record.toFactory(("id", str), ("footprint", str),
+                                          ("quantity", int))}
+        recs = store.RecordStore(facts)
+        for (i, f, q) in [("3", "b", 5), ("1", "b", 7), ("2", "a", 5), ("4", "a", 2)]:
+            recs.add(("Part", facts["Part"].generateRecord([("id", i), ("footprint", f),
+                                                            ("quantity", q)])))
+        return (facts, recs)
+
+    def ids(self, result):
+        self.assertTrue(result[0])
+        return [x.split('"')[1] for x in result[1].splitlines()]
+
+    def test_sort(self):
+        (facts, recs) = ProtocolTests.genStore()
+        send = lambda msg: interpretMessage(msg, facts, recs)
+
+        self.assertEqual(self.ids(send('list\nsort Part by quantity')), ["4", "3", "2", "1"])
+        self.assertEqual(self.ids(send('list\nsort Part by quantity, id')), ["4", "2", "3", "1"])
+        self.assertEqual(self.ids(send('list\nsort Part by footprint, quantity, id')),
+                         ["4", "2", "3", "1"])
+        self.assertEqual(self.ids(send('list\nsort Part by footprint')), ["2", "4", "3", "1"])
+        self.assertFalse(send('list\nsort Part by lalala')[0])
+
+        # Nones go last, and top-k agrees with a full sort.
+        entries = [r for (_, r) in recs]
+        entries.append(facts["Part"].generateRecord([("id", "0"), ("quantity", 9)]))
+        self.assertEqual([r.getAttribute("id") for r in _sortRecords(entries, ["footprint", "id"])],
+                         ["2", "4", "1", "3", "0"])
+        for limit in range(6):
+            self.assertEqual(_sortRecords(entries, ["footprint", "quantity"], limit),
+                             _sortRecords(entries, ["footprint", "quantity"])[:limit])
+
+        # Values of different types in one field still sort.
+        entries[0].values[0] = 3
+        self.assertEqual(len(_sortRecords(entries, ["id"])), 5)
+
+    def test_page(self):
+        (facts, recs) = ProtocolTests.genStore()
+        send = lambda msg: interpretMessage(msg, facts, recs)
+
+        self.assertEqual(self.ids(send('list\nlimit 2')), ["3", "1"])
+        self.assertEqual(self.ids(send('list\noffset 1\nlimit 2')), ["1", "2"])
+        self.assertEqual(self.ids(send('list\noffset 3')), ["4"])
+        self.assertEqual(send('list\noffset 4'), (True, None))
+        self.assertEqual(send('list\nlimit 0'), (True, None))
+        self.assertEqual(self.ids(send('list\nsort Part by quantity, id\noffset 1\nlimit 2')),
+                         ["2", "3"])
+        self.assertEqual(self.ids(send('list\nPart: footprint="b"\nsort Part by id\nlimit 1')),
+                         ["1"])
+        self.assertFalse(send('list\nlimit lots')[0])
+
+    def test_range(self):
+        (facts, recs) = ProtocolTests.genStore()
+        send = lambda msg: interpretMessage(msg, facts, recs)
+
+        self.assertEqual(self.ids(send('list\nPart: quantity<"6"\nsort Part by id')), ["2", "3", "4"])
+        self.assertEqual(self.ids(send('list\nPart: quantity>="5" footprint="b"')), ["3", "1"])
+        self.assertEqual(self.ids(send('list\nPart: quantity="6.."\nPart: id="4"')), ["1", "4"])
+        self.assertTrue(send('rm\nPart: quantity<="5" footprint="a"')[0])
+        self.assertEqual(self.ids(send('list')), ["3", "1"])
+
+        # Comparisons that can't work say so rather than matching nothing.
+        self.assertEqual(send('list\nPart: id<"5"'),
+                         (False, 'Can\'t match id against "<5": comparisons only work on numbers'))
+        self.assertEqual(send('list\nPart: quantity<"5.5"'),
+                         (False, 'Can\'t match quantity against "<5.5": that isn\'t a range of ints'))
+        self.assertEqual(send('rm\nPart: quantity>"lots"')[0], False)
+        self.assertEqual(self.ids(send('list')), ["3", "1"])
+
+    def test_update(self):
+        (facts, recs) = ProtocolTests.genStore()
+        send = lambda msg: interpretMessage(msg, facts, recs)
+
+        self.assertEqual(send('set\nPart: footprint="b"\nPart: quantity="9"\n'
+                              'Part: id="2"\nPart: footprint="c"'), (True, None))
+        self.assertEqual(self.ids(send('list\nPart: quantity="9"')), ["3", "1"])
+        self.assertEqual(self.ids(send('list\nPart: footprint="c"')), ["2"])
+
+        # Values that can't be cast get left alone, and summed up.
+        self.assertEqual(send('set\nPart: quantity=">5"\nPart: quantity="lots" footprint="d"'),
+                         (True, 'Updated 2 records. Couldn\'t set quantity to "lots".'))
+        self.assertEqual(self.ids(send('list\nPart: footprint="d" quantity="9"')), ["3", "1"])
+        self.assertFalse(send('set\nPart: id="2"')[0])
+        self.assertEqual(send('set\nPart: quantity<"6"\nPart: quantity>"6"'),
+                         (False, 'quantity>"6" is a comparison, which only works when matching '
+                                 'records'))
+        self.assertEqual(send('set\nThing: id="2"\nThing: quantity="9"'),
+                         (False, "Unknown record type Thing"))
+        self.assertEqual(self.ids(send('list\nPart: quantity="9"')), ["3", "1"])
+
+    def test_add(self):
+        (facts, recs) = ProtocolTests.genStore()
+        send = lambda msg: interpretMessage(msg, facts, recs)
+
+        self.assertEqual(send('add\nPart: id="5" footprint="c" quantity="1"\nPart: id="6" footprint="c" quantity="2"'),
+                         (True, None))
+        self.assertEqual(send('add\nPart: id="7" quantity="1"\nPart: id="8" quantity="lots"\n'
+                              'Part: id="9" quantity="1.5"'),
+                         (False, 'One or more records had invalid data: '
+                                 'record 2 quantity="lots", record 3 quantity="1.5"'))
+        self.assertEqual(send('add\nPart: id="7" lol="1"'),
+                         (False, "One or more records had invalid data."))
+        self.assertEqual(send('add\nThing: id="7"'),
+                         (False, "One or more records had invalid data."))
+        self.assertEqual(send('add'), (False, "No records to add."))
+        self.assertEqual(send('add\nPart: id<"5" footprint="c" quantity="1"'),
+                         (False, 'id<"5" is a comparison, which only works when matching records'))
+        self.assertEqual(self.ids(send('list\nPart: footprint="c"')), ["5", "6"])
+
+    def test_remove(self):
+        (facts, recs) = ProtocolTests.genStore()
+        send = lambda msg: interpretMessage(msg, facts, recs)
+
+        # Nothing can be a record type we don't know, so nothing goes.
+        self.assertEqual(send('rm\nThing: id="1"\n\n\n'), (True, None))
+        self.assertEqual(len(recs), 4)
+        self.assertEqual(send('rm\nThing: id="1"\nPart: quantity="5"'), (True, None))
+        self.assertEqual(self.ids(send('list')), ["1", "4"])
+
+    def test_cache(self):
+        (facts, recs) = ProtocolTests.genStore()
+        send = lambda msg: interpretMessage(msg, facts, recs)
+        cache = ResultCache(maxSize = 2)
+        sent = []
+        def lookup(msg):
+            return cache.lookup(recs, msg, lambda: sent.append(msg) or send(msg))
+
+        self.assertEqual(self.ids(lookup('list\nPart: footprint="b"')), ["3", "1"])
+        self.assertEqual(self.ids(lookup('list\nPart: footprint="b"')), ["3", "1"])
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(cache.info(), (1, 1, 2, 1))
+        self.assertEqual(cache.info().hitRate, 0.5)
+
+        # Changes make everything from before stale.
+        send('set\nPart: id="1"\nPart: footprint="a"')
+        self.assertEqual(self.ids(lookup('list\nPart: footprint="b"')), ["3"])
+        self.assertEqual(len(sent), 2)
+
+        # Least recently used goes first.
+        lookup('list\nPart: id="2"')
+        lookup('list\nPart: footprint="b"')
+        lookup('list\nPart: id="4"')
+        self.assertEqual(cache.info().currsize, 2)
+        lookup('list\nPart: footprint="b"')
+        lookup('list\nPart: id="2"')
+        self.assertEqual(sent[-2:], ['list\nPart: id="4"', 'list\nPart: id="2"'])
+
+        # Through the protocol, layout doesn't matter but the store does.
+        listCache.clear()
+        send('list\nPart: id="2"\nsort Part by id')
+        send('list\n\n   Part: id="2"  \nsort Part by id\n')
+        self.assertEqual(listCache.info().hits, 1)
+        (_, other) = ProtocolTests.genStore()
+        interpretMessage('rm\nPart: id="2"', facts, other)
+        self.assertEqual(interpretMessage('list\nPart: id="2"\nsort Part by id', facts, other),
+                         (True, None))
+        self.assertEqual(listCache.info().hits, 1)
+
+    def test_batch(self):
+        (facts, recs) = ProtocolTests.genStore()
+        heard = []
+        lines = io.StringIO(
+            '\n\nadd\nPart: id="5" footprint="c" quantity="1"\n\n\n'
+            'add\nPart: id="6" footprint="c" quantity="1"\n\n\n'
+            'add\nPart: id="7" footprint="c" quantity="lots"\n\n\n'
+            'add\nPart: id="8" footprint="c" quantity="1"\n\n\n'
+            'list\nPart: footprint="c"\n\n'
+            'sort Part by id\n\n\n\n\n\n'
+            'rm\n  Part: id="5"  \n\n\n'
+            'list\nPart: footprint="c"')
+        messages = list(iterMessages(lines))
+        self.assertEqual(len(messages), 7)
+        self.assertEqual(messages[4], 'list\nPart: footprint="c"\n\nsort Part by id')
+        self.assertEqual(messages[5], 'rm\nPart: id="5"')
+
+        addListener(heard.append)
+        try:
+            results = [r for (_, r) in interpretMessages(messages, facts, recs)]
+        finally:
+            removeListener(heard.append)
+
+        self.assertEqual([r[0] for r in results], [True, True, False, True, True, True, True])
+        self.assertEqual(self.ids(results[4]), ["5", "6", "8"])
+        self.assertEqual(self.ids(results[6]), ["6", "8"])
+        self.assertEqual(heard, [messages[i] for i in [0, 1, 3, 5]])
+        self.assertEqual(len(recs), 6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,25 +1,87 @@
 #!/usr/bin/python
 
 import attribute
-import copy
 import parser
 import unittest
 
+#
+# Schema class:
+# The per-attribute metadata (names, types, defaults, whether they're required)
+# that's the same for every record of a type. A RecordFactory builds one Schema
+# and every Record it generates shares it, so a Record itself only holds a
+# list of values, in the order of schema.names.
+#
+class Schema:
+    def __init__(self, attrs):
+        if attrs is None:
+            raise ValueError("Can't create a Schema from None")
+        self.names = tuple(attrs.keys())
+        self.positions = dict((k, i) for (i, k) in enumerate(self.names))
+        self.types = tuple(a.getType() for a in attrs.values())
+        self.required = tuple(a.required for a in attrs.values())
+        self.multi = tuple(a.multipleAllowed() for a in attrs.values())
+        self.defaults = tuple(a.asNatural() for a in attrs.values())
+        # name -> (position, type), so a factory can fill values in one lookup.
+        self.slots = dict((k, (i, self.types[i])) for (i, k) in enumerate(self.names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def makeAttribute(self, pos, value):
+        "Builds a standalone Attribute for the attribute at pos, holding value."
+        at = attribute.Attribute()
+        at.setType(self.types[pos])
+        at.value = value
+        at.multi = self.multi[pos]
+        at.required = self.required[pos]
+        return at
+
+#
+# Record class:
+# One record's values, in the order of its schema. The line it prints as (see
+# __str__) gets kept around until setAttribute changes it, so listing or
+# writing out the same records again doesn't format them all over again.
+# Values changed any other way than setAttribute won't be noticed.
+#
 class Record:
+    __slots__ = ('schema', 'values', 'line')
+
     def __init__(self, attrs):
+        "attrs is either a Schema, or a dict of name -> Attribute to build one from."
         if attrs is None or len(attrs) == 0:
             raise ValueError("Can't create a Record with no attributes")
-        self.attributes = copy.deepcopy(attrs)
+        if not isinstance(attrs, Schema):
+            attrs = Schema(attrs)
+        self.schema = attrs
+        self.values = list(attrs.defaults)
+        self.line = None
+
+    @classmethod
+    def _fromValues(cls, schema, values):
+        """Builds a record around an already-cast list of values, without going
+through __init__. Only for factories that know schema and values line up."""
+        result = cls.__new__(cls)
+        result.schema = schema
+        result.values = values
+        result.line = None
+        return result
+
+    @property
+    def attributes(self):
+        """A dict of name -> Attribute copies of this record's values. Changing
+the Attributes doesn't change the record; use setAttribute for that."""
+        return dict((k, self.schema.makeAttribute(i, v))
+                    for (i, (k, v)) in enumerate(self.items()))
 
     def __contains__(self, obj):
-        if type(obj) is Attribute:
-            for i in self.attributes:
+        if type(obj) is attribute.Attribute:
+            for i in self.attributes.values():
                 if i == obj:
                     return True
             return False
 
         if type(obj) is str:
-            if obj in self.attributes:
+            if obj in self.schema.positions:
                 return True
         return False
 
@@ -27,74 +89,143 @@ class Record:
         if type(self) is not type(other):
             raise ValueError("Can't compare Record to " + str(type(other)))
 
-        if len(self.attributes) != len(other.attributes):
+        if len(self.schema) != len(other.schema):
             return False
 
-        for i in self.attributes:
+        for i in self.schema.names:
             if i not in other:
                 return False
         return True
 
     def __str__(self):
+        if self.line is not None:
+            return self.line
         if not self.isValid():
             raise ValueError("Invalid string conversion!")
 
-        result = ""
-        for (k,v) in self.attributes.items():
-            if not v.isNull():
-                result += ' {0}="{1}"'.format(k,v.asStr())
-        return result
+        self.line = "".join(' {0}="{1}"'.format(k, attribute.valueAsStr(t, v))
+                            for (k, t, v) in zip(self.schema.names, self.schema.types,
+                                                 self.values) if v is not None)
+        return self.line
 
     def _parseString():
         pass
 
+    def copy(self):
+        "Returns a record with the same schema and its own copy of the values."
+        result = type(self)._fromValues(self.schema, list(self.values))
+        result.line = self.line
+        return result
+
+    def items(self):
+        "Returns (name, value) pairs for every attribute, in schema order."
+        return zip(self.schema.names, self.values)
+
     def isValid(self):
-        for i in self.attributes.values():
-            if i.required and i.isNull():
+        for (req, v) in zip(self.schema.required, self.values):
+            if req and v is None:
                 return False
         return True
 
     def getAttribute(self, attrStr):
-        at = self.getRawAttribute(attrStr)
-        return None if at is None else at.asNatural()
+        at = self.schema.positions.get(attrStr)
+        return None if at is None else self.values[at]
 
     def getRawAttribute(self, attrStr):
-        if attrStr is None or attrStr not in self.attributes:
+        "Returns a standalone Attribute copy of attrStr, or None."
+        at = self.schema.positions.get(attrStr)
+        if at is None:
             return None
-        return self.attributes[attrStr]
+        return self.schema.makeAttribute(at, self.values[at])
 
     def setAttribute(self, attrStr, value):
-        at = self.getRawAttribute(attrStr)
+        at = self.schema.positions.get(attrStr)
         if at is None:
             return False
-        try:
-            return at.setValue(value)
-        except:
-            return False
+        (success, self.values[at]) = attribute.castValue(self.schema.types[at], value)
+        self.line = None
+        return success
 
     def setRawAttribute(self, attrStr, attr):
-        "Sets an attribute's value"
-        if attrStr is None or attr is None or attrStr not in self.attributes:
+        "Sets an attribute's value from attr"
+        if attrStr is None or attr is None or attrStr not in self.schema.positions:
             return False
         if type(attr) is not attribute.Attribute:
             raise ValueError("Can't set attribute to non-attribute")
-        self.attributes[attrStr] = attr
-        return True
+        return self.setAttribute(attrStr, attr.asNatural())
 
     def hasAttribute(self, attrStr):
-        return attrStr in self.attributes
+        return attrStr in self.schema.positions
+
+    def compileCriteria(self):
+        """Returns the compiled regexes for this (match) record's basic regex
+criteria, keyed by attribute name, to be handed to meetsCriteria."""
+        result = {}
+        for (k, v) in self.items():
+            if attribute.isBasicRegex(v):
+                result[k] = attribute.strToRegex(v)
+        return result
+
+    def compileMatcher(self):
+        """Returns a predicate matches(record) that's the same as
+record.meetsCriteria(self), for matching lots of records against this (match)
+record. The criteria get cast, parsed as ranges or compiled as regexes once per
+schema rather than once per record, and the exact ones (the cheapest) are
+checked first."""
+        criteria = [(k, v) for (k, v) in self.items() if v is not None]
+        compiled = {}
+
+        def build(schema):
+            exact = []
+            tests = []
+            for (k, v) in criteria:
+                slot = schema.slots.get(k)
+                if slot is None:
+                    return None
+                (wanted, test) = attribute.compileCriteria(slot[1], v)
+                if test is None:
+                    exact.append((slot[0], wanted))
+                else:
+                    tests.append((slot[0], test))
+            return (exact, tests)
+
+        def matches(rec):
+            try:
+                checks = compiled[rec.schema]
+            except KeyError:
+                checks = compiled[rec.schema] = build(rec.schema)
+            if checks is None:
+                return False
 
-    def meetsCriteria(self, criteria):
-        "Returns whether the given statement meets the given criteria."
+            values = rec.values
+            for (at, wanted) in checks[0]:
+                if values[at] != wanted:
+                    return False
+            for (at, test) in checks[1]:
+                v = values[at]
+                if v is None or not test(v):
+                    return False
+            return True
+        return matches
 
-        if criteria is None or criteria.attributes is None:
+    def meetsCriteria(self, criteria, compiled = None):
+        """Returns whether the given statement meets the given criteria.
+compiled may be criteria.compileCriteria(), so that matching many records
+against one criteria only compiles its regexes once."""
+
+        if criteria is None:
             return False
 
-        # We do want criteria.attributes == [] to fall through and return True.
-        for k, v in criteria.attributes.items():
-            if not v.isNull():
-                attr = self.getRawAttribute(k)
-                if attr is None or attr.isNull() or not attr.matchesCriteria(v.asNatural()):
+        positions = self.schema.positions
+        # We do want a criteria with no values to fall through and return True.
+        for (k, v) in criteria.items():
+            if v is not None:
+                at = positions.get(k)
+                if at is None or self.values[at] is None:
+                    return False
+                reg = None if compiled is None else compiled.get(k)
+                if not attribute.valueMatchesCriteria(self.schema.types[at],
+                                                      self.values[at], v, reg = reg):
                     return False
                     
         return True
@@ -103,26 +234,94 @@ class RecordFactory:
     def __init__(self):
         self.attrs = {}
         self.matchAttrs = {}
+        self.schema = None
+        self.matchSchema = None
         self.recType = Record
+        self.frozen = False
+
+    def _checkFrozen(self):
+        if self.frozen:
+            raise ValueError("Can't change a frozen RecordFactory")
+
+    def freeze(self):
+        """Builds the schemas now and stops the factory from changing, so it can
+be shared by everything that uses it. Returns the factory."""
+        self.getSchema()
+        self.getMatchSchema()
+        self.frozen = True
+        return self
 
     def setFactoryType(self, recordType):
         if recordType is None:
             raise ValueError("recordType can't be None")
+        self._checkFrozen()
         self.recType = recordType
 
     def addAttribute(self, attrName, attr):
         if attrName is None or attr is None:
             return False
+        self._checkFrozen()
 
         self.attrs[attrName] = attr
-        mattr = copy.deepcopy(attr)
+        mattr = attr.copy()
         mattr.setType(str)
         self.matchAttrs[attrName] = mattr
 
+        # The schemas get rebuilt the next time they're needed.
+        self.schema = None
+        self.matchSchema = None
         return True
 
-    def _generateRecord(self, attrs, fromKv):
-        result = self.recType(attrs)
+    def getSchema(self):
+        "Returns the Schema shared by every record this generates."
+        if self.schema is None:
+            self.schema = Schema(self.attrs)
+        return self.schema
+
+    def getMatchSchema(self):
+        "Returns the Schema shared by every match record this generates."
+        if self.matchSchema is None:
+            self.matchSchema = Schema(self.matchAttrs)
+        return self.matchSchema
+
+    def _invalidKv(self, key, value):
+        errstr = ( "Invalid key or value for record ({0} ;; {1}). Available "
+                 + "keys are ").format(key, value)
+        for i in self.attrs:
+            errstr += i + " "
+        return ValueError(errstr)
+
+    def _generateRecord(self, schema, fromKv):
+        # Plain Records get built straight from a copy of the schema defaults.
+        # Subclasses might do something in __init__, so they get the slow path.
+        if self.recType is not Record or len(schema) == 0:
+            return self._generateRecordSlow(schema, fromKv)
+
+        values = list(schema.defaults)
+        if fromKv is None:
+            return Record._fromValues(schema, values)
+
+        slots = schema.slots
+        for i in fromKv:
+            if len(i) == 1:
+                return self._generateRecordSlow(schema, fromKv)
+            assert len(i) == 2
+            (key, value) = i
+            slot = slots.get(key)
+            if slot is None:
+                raise self._invalidKv(key, value)
+            (pos, type_) = slot
+            if value is None or type(value) is type_:
+                values[pos] = value
+            else:
+                try:
+                    values[pos] = type_(value)
+                except:
+                    raise self._invalidKv(key, value)
+        return Record._fromValues(schema, values)
+
+    def _generateRecordSlow(self, schema, fromKv):
+        result = self.recType(schema)
 
         if fromKv is None:
             return result
@@ -134,18 +333,97 @@ class RecordFactory:
             assert len(i) == 2
             (key, value) = i
             if not result.setAttribute(key, value):
-                errstr = ( "Invalid key or value for record ({0} ;; {1}). Available "
-                         + "keys are ").format(key, value)
-                for i in self.attrs:
-                    errstr += i + " "
-                raise ValueError(errstr)
+                raise self._invalidKv(key, value)
         return result
             
     def generateRecord(self, fromKv):
-        return self._generateRecord(self.attrs, fromKv)
+        return self._generateRecord(self.getSchema(), fromKv)
         
+    def generateRecords(self, kvLists):
+        """Builds a record from each list of (key, value) pairs in kvLists, like
+generateRecord would, but casts the values a column at a time: all of one
+attribute's values at once. Returns (records, failures). failures are the
+(row, key, value) of values that couldn't be cast, in row order; rows with any
+get None instead of a record. An unknown key is still a ValueError."""
+        schema = self.getSchema()
+        kvLists = [[] if x is None else x for x in kvLists]
+        if self.recType is not Record or len(schema) == 0 \
+                or any(len(i) != 2 for x in kvLists for i in x):
+            return self._generateRecordsSlow(kvLists)
+
+        slots = schema.slots
+        columns = [([], []) for _ in schema.names]
+        for (row, kv) in enumerate(kvLists):
+            for (key, value) in kv:
+                slot = slots.get(key)
+                if slot is None:
+                    raise self._invalidKv(key, value)
+                (rows, raw) = columns[slot[0]]
+                rows.append(row)
+                raw.append(value)
+
+        values = [list(schema.defaults) for _ in kvLists]
+        failures = []
+        for (pos, (rows, raw)) in enumerate(columns):
+            (converted, bad) = attribute.convertColumn(schema.types[pos], raw)
+            for (row, v) in zip(rows, converted):
+                values[row][pos] = v
+            failures += [(rows[i], schema.names[pos], v) for (i, v) in bad]
+
+        failures.sort(key = lambda x: x[0])
+        failed = set(x[0] for x in failures)
+        return ([None if row in failed else Record._fromValues(schema, v)
+                 for (row, v) in enumerate(values)], failures)
+
+    def _generateRecordsSlow(self, kvLists):
+        records = []
+        failures = []
+        for (row, kv) in enumerate(kvLists):
+            rec = self.recType(self.getSchema())
+            bad = []
+            for i in kv:
+                if len(i) == 1:
+                    rec._parseString(i[0])
+                    continue
+                (key, value) = i
+                if not rec.hasAttribute(key):
+                    raise self._invalidKv(key, value)
+                if not rec.setAttribute(key, value):
+                    bad.append((row, key, value))
+            failures += bad
+            records.append(None if len(bad) > 0 else rec)
+        return (records, failures)
+
     def generateMatchRecord(self, fromKv):
-        return self._generateRecord(self.matchAttrs, fromKv)
+        return self._generateRecord(self.getMatchSchema(), fromKv)
+
+def toFactory(*attrs, factoryType = None):
+    """Builds a RecordFactory with the given attributes.
+Each attribute must be in the form (name, type[, default value]),
+otherwise this will fail."""
+    if attrs is None or len(attrs) == 0:
+        raise ValueError("attrs must be len > 0 and not None")
+
+    fact = RecordFactory()
+    if factoryType is not None:
+        fact.setFactoryType(factoryType)
+
+    for i in attrs:
+        assert len(i) in [2, 3]
+        attr = attribute.Attribute()
+        name = None
+        if len(i) == 3:
+            (name, attrType, attrDefault) = i
+            attr.setType(attrType)
+            attr.setValue(attrDefault)
+        elif len(i) == 2:
+            (name, attrType) = i
+            attr.setType(attrType)
+        if name is None:
+            raise ValueError("Can't assign None name to attribute")
+        fact.addAttribute(name, attr)
+
+    return fact
 
 class RecordTests(unittest.TestCase):
     @staticmethod
@@ -261,6 +539,152 @@ class RecordTests(unittest.TestCase):
         rec = rf.generateRecord(None)
         self.assertEqual(type(rec), RecordTests.RecordTest)
 
+        # Frozen factories keep working, but can't be changed.
+        schema = rf.getSchema()
+        self.assertIs(rf.freeze(), rf)
+        self.assertIs(rf.getSchema(), schema)
+        self.assertRaises(ValueError, rf.addAttribute, "attr4", attribute.Attribute())
+        self.assertRaises(ValueError, rf.setFactoryType, Record)
+        self.assertEqual(rf.generateRecord([("attr3", "4")]).getAttribute("attr3"), 4)
+
+    def test_schema(self):
+        rf = RecordFactory()
+        rf.addAttribute("attr1", attribute.Attribute())
+        at = attribute.Attribute()
+        at.setType(int)
+        at.setValue(3)
+        rf.addAttribute("attr2", at)
+
+        rec1 = rf.generateRecord([("attr1", "hello")])
+        rec2 = rf.generateRecord([("attr1", "world"), ("attr2", "4")])
+        self.assertIs(rec1.schema, rec2.schema)
+        self.assertIs(rec1.schema, rf.getSchema())
+        self.assertFalse(hasattr(rec1, "__dict__"))
+        self.assertEqual(rec1.values, ["hello", 3])
+        self.assertEqual(list(rec2.items()), [("attr1", "world"), ("attr2", 4)])
+        self.assertEqual(str(rec2), ' attr1="world" attr2="4"')
+
+        # Raw attributes are copies; they don't write through.
+        at = rec1.getRawAttribute("attr2")
+        at.setValue(10)
+        self.assertEqual(rec1.getAttribute("attr2"), 3)
+        self.assertTrue(rec1.setRawAttribute("attr2", at))
+        self.assertEqual(rec1.getAttribute("attr2"), 10)
+        self.assertIn("attr1", rec1)
+        self.assertNotIn("attr3", rec1)
+        self.assertTrue(rec1 == rec2)
+
+        rec4 = rec1.copy()
+        self.assertIs(rec4.schema, rec1.schema)
+        rec4.setAttribute("attr1", "copy")
+        self.assertEqual(rec1.getAttribute("attr1"), "hello")
+
+        # Adding attributes makes the factory build a new schema.
+        rf.addAttribute("attr3", attribute.Attribute())
+        rec3 = rf.generateRecord(None)
+        self.assertIsNot(rec3.schema, rec1.schema)
+        self.assertEqual(rec3.values, [None, 3, None])
+        self.assertEqual(len(rec3.schema), 3)
+        self.assertIs(rf.getMatchSchema().types[1], str)
+
+    def test_generate(self):
+        rf = RecordFactory()
+        rf.addAttribute("attr1", attribute.Attribute())
+        at = attribute.Attribute()
+        at.setType(int)
+        rf.addAttribute("attr2", at)
+
+        # The fast path and the subclass path have to agree.
+        for recType in [Record, RecordTests.RecordTest]:
+            rf.setFactoryType(recType)
+            rec = rf.generateRecord([("attr1", "hi"), ("attr2", "32")])
+            self.assertIs(type(rec), recType)
+            self.assertEqual(rec.getAttribute("attr1"), "hi")
+            self.assertEqual(rec.getAttribute("attr2"), 32)
+            rec = rf.generateRecord([("attr2", 5)])
+            self.assertIsNone(rec.getAttribute("attr1"))
+            self.assertIs(rec.getAttribute("attr2"), 5)
+            self.assertRaises(ValueError, rf.generateRecord, [("attr2", "lol")])
+            self.assertRaises(ValueError, rf.generateRecord, [("attr3", "1")])
+
+            # Records don't share their values.
+            rec1 = rf.generateRecord(None)
+            rec2 = rf.generateRecord(None)
+            rec1.setAttribute("attr1", "x")
+            self.assertIsNone(rec2.getAttribute("attr1"))
+
+    def test_generateRecords(self):
+        rf = RecordFactory()
+        rf.addAttribute("attr1", attribute.Attribute())
+        at = attribute.Attribute()
+        at.setType(int)
+        at.setValue(5)
+        rf.addAttribute("attr2", at)
+
+        kvs = [[("attr1", "a"), ("attr2", "1")], None, [("attr2", "lots")],
+               [("attr1", "b"), ("attr2", 3)], [("attr2", "x"), ("attr1", "c")]]
+        for recType in [Record, RecordTests.RecordTest]:
+            rf.setFactoryType(recType)
+            (recs, failures) = rf.generateRecords(kvs)
+            self.assertEqual(failures, [(2, "attr2", "lots"), (4, "attr2", "x")])
+            self.assertEqual([None if r is None else r.values for r in recs],
+                             [["a", 1], [None, 5], None, ["b", 3], None])
+            self.assertEqual([type(r) for r in recs if r is not None], [recType] * 3)
+            self.assertEqual(recs[0].values, rf.generateRecord(kvs[0]).values)
+            self.assertRaises(ValueError, rf.generateRecords, [[("attr3", "1")]])
+        self.assertEqual(rf.generateRecords([]), ([], []))
+
+    def test_str(self):
+        rf = RecordFactory()
+        rf.addAttribute("attr1", attribute.Attribute())
+        at = attribute.Attribute()
+        at.setType(int)
+        rf.addAttribute("attr2", at)
+
+        rec = rf.generateRecord([("attr1", "a")])
+        self.assertRaises(ValueError, str, rec)
+        self.assertTrue(rec.setAttribute("attr2", "3"))
+        self.assertEqual(str(rec), ' attr1="a" attr2="3"')
+        self.assertIs(str(rec), rec.line)
+
+        # Changes get printed, and copies print the same as what they're of.
+        rec2 = rec.copy()
+        self.assertTrue(rec.setRawAttribute("attr1", rf.attrs["attr1"]))
+        self.assertRaises(ValueError, str, rec)
+        self.assertTrue(rec.setAttribute("attr1", "b"))
+        self.assertEqual(str(rec), ' attr1="b" attr2="3"')
+        self.assertFalse(rec.setAttribute("attr2", "lots"))
+        self.assertRaises(ValueError, str, rec)
+        self.assertEqual(str(rec2), ' attr1="a" attr2="3"')
+
+    def test_criteria(self):
+        rf = RecordFactory()
+        rf.addAttribute("attr1", attribute.Attribute())
+        at = attribute.Attribute()
+        at.setType(int)
+        rf.addAttribute("attr2", at)
+
+        rec = rf.generateRecord([("attr1", "hello"), ("attr2", "32")])
+        crit = rf.generateMatchRecord([("attr1", "he*"), ("attr2", "32")])
+        compiled = crit.compileCriteria()
+        self.assertEqual(list(compiled.keys()), ["attr1"])
+        self.assertTrue(rec.meetsCriteria(crit))
+        self.assertTrue(rec.meetsCriteria(crit, compiled))
+
+        crit = rf.generateMatchRecord([("attr2", "3*")])
+        self.assertTrue(rec.meetsCriteria(crit, crit.compileCriteria()))
+        crit = rf.generateMatchRecord([("attr1", "*x"), ("attr2", "32")])
+        self.assertFalse(rec.meetsCriteria(crit, crit.compileCriteria()))
+
+        rec2 = rf.generateRecord([("attr1", "hex")])
+        for kv in [[("attr1", "he*")], [("attr1", "he*"), ("attr2", "3*")],
+                   [("attr2", "<40")], [("attr2", "32")], [("attr1", "hello")], [],
+                   [("attr2", "lol")], [("attr1", "*l*"), ("attr2", "30..32")]]:
+            crit = rf.generateMatchRecord(kv)
+            matches = crit.compileMatcher()
+            self.assertEqual(matches(rec), rec.meetsCriteria(crit), kv)
+            self.assertEqual(matches(rec2), rec2.meetsCriteria(crit), kv)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+
+import asyncio
+import concurrent.futures
+import locks
+import os
+import protocol
+import record
+import shutil
+import signal
+import stat
+import store
+import tempfile
+import unittest
+
+#
+# Server:
+# Serves one in-memory inventory to any number of clients, over a Unix domain
+# socket or localhost TCP. Clients talk the same protocol as the prompt: send
+# a message ended by two blank lines, get back the reply (what the prompt would
+# print, or "error\n..." if it failed) also ended by two blank lines.
+#
+# Requests run on a thread pool, so the server keeps talking to everyone else
+# while one is busy. They share the records through a locks.RWLock: any number
+# of read requests can run at once, and a mutating request waits for them to
+# finish and runs alone.
+#
+TERMINATOR = '\n\n\n'
+
+def _removeSocket(path):
+    """Removes a socket left at path (say, by a server that didn't get to clean
+up). Anything else at path is left alone, and is an error."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise ValueError(path + " is already in use, and isn't a socket")
+    os.unlink(path)
+
+class InventoryServer:
+    def __init__(self, factories, records, afterWrite = None, sharedReads = True,
+                 workers = 4):
+        """Serves records. afterWrite(records) gets called after every mutating
+request, while it still has the records to itself (e.g. to compact a journal).
+sharedReads says whether records can take several readers at once; a store
+that changes itself on reads (like MappedRecordStore's cache) can't."""
+        if factories is None or records is None:
+            raise ValueError("Need factories and records to serve")
+        self.factories = factories
+        self.records = records
+        self.afterWrite = afterWrite
+        self.lock = locks.RWLock(sharedReads)
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+        self.clients = set()
+
+    def _run(self, message):
+        (act, _) = protocol.splitMessage(message)
+        if act not in protocol.mutating or self.afterWrite is None:
+            return protocol.interpretMessage(message, self.factories, self.records, self.lock)
+
+        with self.lock.writing():
+            result = protocol.interpretMessage(message, self.factories, self.records,
+                                               self.lock)
+            self.afterWrite(self.records)
+        return result
+
+    async def run(self, message):
+        "Runs message and returns its reply."
+        loop = asyncio.get_running_loop()
+        (res, strres) = await loop.run_in_executor(self.pool, self._run, message)
+
+        if res is False:
+            if strres is not None and strres.startswith("error\n"):
+                return strres
+            return protocol.reportError(strres)
+        return 'OK' if strres is None else strres.rstrip('\n')
+
+    async def handle(self, reader, writer):
+        "Talks to one client until it hangs up."
+        splitter = protocol.MessageSplitter()
+        self.clients.add(asyncio.current_task())
+        try:
+            while True:
+                line = await reader.readline()
+                if len(line) == 0:
+                    message = splitter.finish()
+                else:
+                    message = splitter.feed(line.decode(errors = 'replace'))
+                if message is not None:
+                    reply = await self.run(message)
+                    writer.write((reply + TERMINATOR).encode())
+                    await writer.drain()
+                if len(line) == 0:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.clients.discard(asyncio.current_task())
+            writer.close()
+
+    async def close(self):
+        """Hangs up on every client, and waits for requests that already started
+to finish (so the records can be committed after)."""
+        clients = list(self.clients)
+        for i in clients:
+            i.cancel()
+        await asyncio.gather(*clients, return_exceptions = True)
+        self.pool.shutdown(wait = True)
+
+    async def start(self, path = None, port = None, host = '127.0.0.1'):
+        "Starts listening on the Unix socket at path, or on host:port."
+        if path is not None:
+            _removeSocket(path)
+            return await asyncio.start_unix_server(self.handle, path = path)
+        if port is not None:
+            return await asyncio.start_server(self.handle, host = host, port = port)
+        raise ValueError("Need a socket path or a port to listen on")
+
+    async def serve(self, path = None, port = None, host = '127.0.0.1'):
+        "Serves until SIGINT or SIGTERM."
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        srv = await self.start(path, port, host)
+        await stop.wait()
+        srv.close()
+        await self.close()
+        await srv.wait_closed()
+        if path is not None:
+            _removeSocket(path)
+
+class ServerTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "sock")
+        self.facts = {"Part": record.toFactory(("id", str), ("description", str),
+                                               ("footprint", str), ("quantity", int)).freeze()}
+        self.recs = store.RecordStore(self.facts)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    @staticmethod
+    async def send(path, *messages):
+        "Sends messages down one connection and returns the replies."
+        (reader, writer) = await asyncio.open_unix_connection(path)
+        replies = []
+        for message in messages:
+            writer.write((message + TERMINATOR).encode())
+            await writer.drain()
+            replies.append((await reader.readuntil(TERMINATOR.encode())).decode()[:-3])
+        writer.close()
+        return replies
+
+    def test_serve(self):
+        async def run():
+            server = InventoryServer(self.facts, self.recs)
+            srv = await server.start(path = self.path)
+            add = 'add\nPart: id="{0}" description="d" footprint="f" quantity="{0}"'
+            async with srv:
+                # Lots of clients adding at once; every add lands.
+                replies = await asyncio.gather(*[ServerTests.send(self.path, add.format(i))
+                                                 for i in range(20)])
+                self.assertEqual(replies, [['OK']] * 20)
+                self.assertEqual(len(self.recs), 20)
+
+                replies = await ServerTests.send(self.path,
+                                                 'list\nPart: id="1*"\nsort Part by quantity',
+                                                 'rm\nPart: id="1*"',
+                                                 'list\nPart: id="1*"',
+                                                 'lolol',
+                                                 'list\nsort Part by lalala')
+                self.assertEqual([x.split('"')[1] for x in replies[0].splitlines()],
+                                 ["1"] + [str(i) for i in range(10, 20)])
+                self.assertEqual(replies[1:3], ['OK', 'OK'])
+                self.assertTrue(replies[3].startswith("error\n"))
+                self.assertTrue(replies[4].startswith("error\n"))
+                self.assertEqual(len(self.recs), 9)
+                await server.close()
+
+        asyncio.run(run())
+
+    def test_socketPath(self):
+        # Something that isn't a socket doesn't get clobbered.
+        with open(self.path, 'w') as fi:
+            fi.write('Part: id="1"\n')
+        server = InventoryServer(self.facts, self.recs)
+        with self.assertRaises(ValueError):
+            asyncio.run(server.start(path = self.path))
+        self.assertRaises(ValueError, _removeSocket, self.path)
+        with open(self.path) as fi:
+            self.assertEqual(fi.read(), 'Part: id="1"\n')
+        os.unlink(self.path)
+
+        # A socket left behind does.
+        async def run():
+            srv = await server.start(path = self.path)
+            srv.close()
+            await srv.wait_closed()
+            srv = await server.start(path = self.path)
+            srv.close()
+            await srv.wait_closed()
+        asyncio.run(run())
+        _removeSocket(self.path)
+        self.assertFalse(os.path.exists(self.path))
+        _removeSocket(self.path)
+
+if __name__ == '__main__':
+    unittest.main()
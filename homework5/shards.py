@@ -0,0 +1,219 @@
+#!/usr/bin/python
+
+import multiprocessing
+import os
+import parser
+import protocol
+import record
+import store
+import threading
+import time
+import unittest
+
+#
+# ShardPool class:
+# Splits scans of a RecordStore (criteria no index can answer, like "*5*")
+# over worker processes. The workers get started once, with spawn (or a fork
+# server where there is one) rather than a plain fork, since the process they
+# come from may be running threads. Each worker keeps its own copy of one
+# contiguous shard of the store's entries, so a scan only sends the match
+# records over and gets the matching sequence numbers back, and the shards get
+# stitched back together in order.
+#
+# Once the store changes, the workers' copies are stale, and shipping the
+# whole store over again costs a lot more than one serial scan (pickling is
+# slow). So scans of a changed store run serially, and the store only gets
+# shipped to the workers once those serial scans have taken as long as shipping
+# it would (going by how long the last shipment took). A store that keeps
+# changing between scans then never costs more than twice what scanning it
+# serially would, and one that stops changing soon gets scanned in parallel.
+#
+# Scans come from however many readers the store has at once. Serial scans
+# only take the lock (which covers the bookkeeping above) to read and update
+# it, not while they scan, so they run side by side. Talking to the workers,
+# to ship the store or scan it, takes turns, since each has just one pipe.
+#
+def _worker(conn):
+    "Runs in a worker: loads shards and scans them until told to stop."
+    entries = []
+    while True:
+        (what, arg) = conn.recv()
+        if what == 'stop':
+            break
+        try:
+            if what == 'load':
+                entries = arg
+                conn.send(('ok', len(entries)))
+            elif what == 'scan':
+                conn.send(('ok', store.scanEntries(entries, arg)))
+        except Exception as e:
+            conn.send(('error', e))
+    conn.close()
+
+def _context():
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+class ShardPool:
+    def __init__(self, workers = None, minEntries = 50000):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers < 1:
+            raise ValueError("Need at least one worker")
+        self.workers = workers
+        self.minEntries = minEntries
+        self.procs = []
+        self.loadedFor = None
+        self.scanned = (None, 0.0)
+        # Seconds shipping one entry to the workers takes; a guess, until the
+        # first shipment says otherwise.
+        self.shipCost = 2e-5
+        self.lock = threading.Lock()
+        self.talking = threading.Lock()
+
+    def worthIt(self, count):
+        "Returns whether scanning count entries should go to the workers."
+        return count >= self.minEntries
+
+    def start(self):
+        "Starts the workers, if they aren't already. Scans do this when they need to."
+        with self.talking:
+            self._start()
+
+    def _start(self):
+        if len(self.procs) > 0:
+            return
+        ctx = _context()
+        for _ in range(self.workers):
+            (here, there) = ctx.Pipe()
+            proc = ctx.Process(target = _worker, args = (there,), daemon = True)
+            proc.start()
+            there.close()
+            self.procs.append((proc, here))
+
+    def _ask(self, messages):
+        "Sends each worker its message, and returns their answers in order."
+        for ((_, conn), message) in zip(self.procs, messages):
+            conn.send(message)
+        answers = [conn.recv() for (_, conn) in self.procs]
+        for (status, result) in answers:
+            if status == 'error':
+                raise result
+        return [result for (_, result) in answers]
+
+    def _load(self, records):
+        start = time.perf_counter()
+        entries = list(records.entries.items())
+        size = max(1, -(-len(entries) // self.workers))
+        self._ask([('load', entries[i * size:(i + 1) * size]) for i in range(self.workers)])
+        with self.lock:
+            self.loadedFor = (id(records), records.generation)
+            self.shipCost = (time.perf_counter() - start) / max(1, len(entries))
+
+    def scan(self, records, matchRecs):
+        """Returns the sequence numbers of the entries in records (a RecordStore)
+meeting the criteria of any (name, Record) in matchRecs, in store order."""
+        current = (id(records), records.generation)
+        with self.lock:
+            serial = False
+            if self.loadedFor != current:
+                (scanned, spent) = self.scanned
+                if scanned != current:
+                    self.scanned = (current, 0.0)
+                    spent = 0.0
+                serial = spent < self.shipCost * len(records.entries)
+
+        if serial:
+            start = time.perf_counter()
+            result = store.scanEntries(records.entries.items(), matchRecs)
+            took = time.perf_counter() - start
+            with self.lock:
+                (scanned, spent) = self.scanned
+                if scanned == current:
+                    self.scanned = (current, spent + took)
+            return result
+
+        with self.talking:
+            if self.loadedFor != current:
+                self._start()
+                self._load(records)
+            result = []
+            for found in self._ask([('scan', matchRecs)] * self.workers):
+                result.extend(found)
+            return result
+
+    def close(self):
+        "Stops the workers. The next scan that needs them starts new ones."
+        with self.talking:
+            for (proc, conn) in self.procs:
+                try:
+                    conn.send(('stop', None))
+                except OSError:
+                    pass
+                conn.close()
+            for (proc, _) in self.procs:
+                proc.join()
+            self.procs = []
+            with self.lock:
+                self.loadedFor = None
+
+class ShardTests(unittest.TestCase):
+    def test_scan(self):
+        facts = {"Part": record.toFactory(("id", str), ("description", str),
+                                          ("footprint", str), ("quantity", int)).freeze()}
+        lines = ['Part: id="{0}" description="d" footprint="fp{1}" quantity="{1}"'.format(
+                 i, i % 7) for i in range(500)]
+        recs = store.RecordStore(facts, parser.parseStream(lines, facts))
+        pool = ShardPool(workers = 2, minEntries = 100)
+        self.assertFalse(pool.worthIt(99))
+        m = lambda *kv: [("Part", facts["Part"].generateMatchRecord(kv))]
+        ids = lambda entries: [r.getAttribute("id") for (_, r) in entries]
+
+        try:
+            pool.start()
+            serial = ids(recs.match(m(("id", "*5*"))))
+            recs.setShards(pool)
+            # Scans run here until they've cost as much as shipping the store.
+            pool.shipCost = 1.0
+            self.assertEqual(ids(recs.match(m(("id", "*5*")))), serial)
+            self.assertIsNone(pool.loadedFor)
+            pool.shipCost = 0.0
+            self.assertEqual(ids(recs.match(m(("id", "*5*"), ("footprint", "*3")) +
+                                 m(("description", "*d"), ("footprint", "*1")))),
+                             [str(i) for i in range(500) if i % 7 == 1 or
+                              (i % 7 == 3 and '5' in str(i))])
+            self.assertEqual(pool.loadedFor, (id(recs), recs.generation))
+
+            # Changes get through to the workers, once they're worth sending.
+            self.assertGreater(pool.shipCost, 0.0)
+            protocol.interpretMessage('rm\nPart: id="15"', facts, recs)
+            expect = [x for x in serial if x != "15"]
+            pool.shipCost = 1.0
+            self.assertEqual(ids(recs.match(m(("id", "*5*")))), expect)
+            self.assertNotEqual(pool.loadedFor, (id(recs), recs.generation))
+            (_, spent) = pool.scanned
+            pool.shipCost = spent / len(recs.entries)
+            self.assertEqual(ids(recs.match(m(("id", "*5*")))), expect)
+            self.assertEqual(pool.loadedFor, (id(recs), recs.generation))
+
+            # Serial scans don't wait on anyone talking to the workers.
+            protocol.interpretMessage('rm\nPart: id="25"', facts, recs)
+            pool.shipCost = 1.0
+            with pool.talking:
+                found = []
+                scanner = threading.Thread(target = lambda: found.append(
+                    ids(recs.match(m(("id", "*5*"))))))
+                scanner.start()
+                scanner.join(10)
+                self.assertEqual(found, [[x for x in expect if x != "25"]])
+
+            # Errors in the workers come back here.
+            pool.shipCost = 0.0
+            self.assertRaises(AttributeError, pool.scan, recs, [("Part", None)])
+            self.assertEqual(pool.loadedFor, (id(recs), recs.generation))
+        finally:
+            pool.close()
+        self.assertEqual(pool.procs, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,250 @@
+#!/usr/bin/python
+
+import array
+import gc
+import json
+import os
+import record
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+#
+# Binary snapshots:
+# A snapshot is a columnar copy of an inventory file, written next to it as
+# <file>.snap, that loads without any text parsing or type conversion. It
+# starts with a magic number, the size and mtime of the text file it was taken
+# from (a snapshot of any other version of the file is stale), and a JSON
+# header describing the schema of every record type in it. Then comes one
+# array of record type numbers (so records come back in file order), and for
+# each record type, one column per attribute:
+#   str    -> character lengths (-1 for None), then the UTF-8 of every value
+#   int    -> presence bytes, then int64s
+#   float  -> presence bytes, then doubles
+# ints too big for an int64 get written as a str column and cast on the way in.
+#
+MAGIC = b'INVSNAP\x01'
+_typeNames = {str: 'str', int: 'int', float: 'float'}
+_fileHeader = struct.Struct('<8sQQI')
+_columnHeader = struct.Struct('<cQ')
+
+def snapshotPath(filePath):
+    "Where the snapshot of the inventory at filePath lives."
+    return filePath + '.snap'
+
+def _describe(factories):
+    "Returns the JSON-able schema of factories, or None if we can't snapshot it."
+    result = []
+    for (name, fact) in sorted(factories.items()):
+        schema = fact.getSchema()
+        attrs = []
+        for (k, type_) in zip(schema.names, schema.types):
+            if type_ not in _typeNames:
+                return None
+            attrs.append([k, _typeNames[type_]])
+        result.append({'name': name, 'attrs': attrs})
+    return result
+
+def _packColumn(type_, values):
+    if type_ is int and all(v is None or -2**63 <= v < 2**63 for v in values):
+        present = array.array('b', (v is not None for v in values))
+        data = array.array('q', (0 if v is None else v for v in values))
+        return (b'i', present.tobytes() + data.tobytes())
+    if type_ is float:
+        present = array.array('b', (v is not None for v in values))
+        data = array.array('d', (0.0 if v is None else v for v in values))
+        return (b'f', present.tobytes() + data.tobytes())
+
+    strs = [None if v is None else (v if type_ is str else str(v)) for v in values]
+    lengths = array.array('q', (-1 if v is None else len(v) for v in strs))
+    blob = ''.join(v for v in strs if v is not None).encode()
+    return (b's', lengths.tobytes() + struct.pack('<Q', len(blob)) + blob)
+
+def _unpackColumn(kind, type_, data, count, swap):
+    def arr(typecode, raw):
+        result = array.array(typecode)
+        result.frombytes(raw)
+        if swap:
+            result.byteswap()
+        return result
+
+    if kind in (b'i', b'f'):
+        present = data[:count]
+        values = arr('q' if kind == b'i' else 'd', data[count:])
+        if len(present) != count or len(values) != count:
+            raise ValueError("Truncated column")
+        return [v if p else None for (p, v) in zip(present, values)]
+
+    assert kind == b's'
+    lengths = arr('q', data[:8 * count])
+    blob = bytes(data[8 * count + 8:]).decode()
+    result = []
+    at = 0
+    for n in lengths:
+        if n < 0:
+            result.append(None)
+        else:
+            result.append(blob[at:at + n])
+            at += n
+    if len(result) != count or at != len(blob):
+        raise ValueError("Truncated column")
+    if type_ is not str:
+        result = [None if v is None else type_(v) for v in result]
+    return result
+
+def writeSnapshot(filePath, records, factories):
+    """Writes a snapshot of records (which must be what's in filePath right now)
+next to filePath. Returns whether it could. Like the text file, it leaves out
+records that aren't valid (missing required values)."""
+    described = _describe(factories)
+    if described is None:
+        return False
+    names = [x['name'] for x in described]
+    numbers = dict((k, i) for (i, k) in enumerate(names))
+
+    columns = dict((k, [[] for _ in factories[k].getSchema().names]) for k in names)
+    order = array.array('H')
+    checked = set()
+    for x in records:
+        if x is None or x[0] is None or x[1] is None or not x[1].isValid():
+            continue
+        (k, r) = x
+        if k not in numbers:
+            return False
+        if id(r.schema) not in checked:
+            schema = factories[k].getSchema()
+            if r.schema.names != schema.names or r.schema.types != schema.types:
+                return False
+            checked.add(id(r.schema))
+        order.append(numbers[k])
+        for (col, v) in zip(columns[k], r.values):
+            col.append(v)
+
+    st = os.stat(filePath)
+    header = json.dumps({'types': described, 'count': len(order),
+                         'byteorder': sys.byteorder}).encode()
+    tmpPath = snapshotPath(filePath) + '.tmp'
+    with open(tmpPath, 'wb') as fi:
+        fi.write(_fileHeader.pack(MAGIC, st.st_size, st.st_mtime_ns, len(header)))
+        fi.write(header)
+        fi.write(order.tobytes())
+        for k in names:
+            schema = factories[k].getSchema()
+            for (type_, col) in zip(schema.types, columns[k]):
+                (kind, data) = _packColumn(type_, col)
+                fi.write(_columnHeader.pack(kind, len(data)))
+                fi.write(data)
+    os.replace(tmpPath, snapshotPath(filePath))
+    return True
+
+def readSnapshot(filePath, factories):
+    """Returns the (name, Record) entries of filePath from its snapshot, or None
+if there isn't an up to date snapshot for this schema."""
+    # Loading allocates millions of objects and frees none of them, so the
+    # cycle collector would only be rescanning them over and over.
+    wasEnabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _readSnapshot(filePath, factories)
+    finally:
+        if wasEnabled:
+            gc.enable()
+
+def _readSnapshot(filePath, factories):
+    try:
+        st = os.stat(filePath)
+        with open(snapshotPath(filePath), 'rb') as fi:
+            data = memoryview(fi.read())
+    except OSError:
+        return None
+
+    try:
+        (magic, size, mtime, headerLen) = _fileHeader.unpack_from(data)
+        if magic != MAGIC or size != st.st_size or mtime != st.st_mtime_ns:
+            return None
+        at = _fileHeader.size
+        header = json.loads(bytes(data[at:at + headerLen]).decode())
+        at += headerLen
+        if header['types'] != json.loads(json.dumps(_describe(factories))):
+            return None
+        swap = header['byteorder'] != sys.byteorder
+
+        count = header['count']
+        order = array.array('H')
+        order.frombytes(data[at:at + 2 * count])
+        if swap:
+            order.byteswap()
+        at += 2 * count
+
+        rows = {}
+        for (i, t) in enumerate(header['types']):
+            schema = factories[t['name']].getSchema()
+            n = order.count(i)
+            cols = []
+            for type_ in schema.types:
+                (kind, length) = _columnHeader.unpack_from(data, at)
+                at += _columnHeader.size
+                cols.append(_unpackColumn(kind, type_, data[at:at + length], n, swap))
+                at += length
+            fromValues = record.Record._fromValues
+            rows[i] = (t['name'], iter([fromValues(schema, list(v)) for v in zip(*cols)]))
+    except (ValueError, KeyError, TypeError, struct.error):
+        return None
+
+    result = []
+    for i in order:
+        (name, it) = rows[i]
+        result.append((name, next(it)))
+    return result
+
+class SnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filePath = os.path.join(self.dir, "parts")
+        self.facts = {"Part": record.toFactory(("id", str), ("description", str),
+                                               ("footprint", str), ("quantity", int)).freeze()}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_roundtrip(self):
+        fact = self.facts["Part"]
+        recs = [("Part", fact.generateRecord([("id", "1"), ("description", "héllo"),
+                                              ("footprint", "a"), ("quantity", "3")])),
+                ("Part", fact.generateRecord([("id", "2"), ("description", "b"),
+                                              ("footprint", ""), ("quantity", str(2**70))])),
+                ("Part", fact.generateRecord([("id", "3")])),
+                None]
+        with open(self.filePath, 'w') as fi:
+            fi.write("whatever\n")
+
+        self.assertIsNone(readSnapshot(self.filePath, self.facts))
+        self.assertTrue(writeSnapshot(self.filePath, recs, self.facts))
+        loaded = readSnapshot(self.filePath, self.facts)
+        self.assertIsNotNone(loaded)
+        # Invalid records (3, which is missing required values) stay out, as
+        # they do of the text file.
+        self.assertEqual([(k, r.values) for (k, r) in loaded],
+                         [(k, r.values) for (k, r) in recs[:2]])
+        self.assertIs(loaded[0][1].schema, fact.getSchema())
+        self.assertIs(type(loaded[1][1].getAttribute("quantity")), int)
+
+        # A different schema, or a changed text file, makes the snapshot stale.
+        other = {"Part": record.toFactory(("id", str), ("quantity", float))}
+        self.assertIsNone(readSnapshot(self.filePath, other))
+        with open(self.filePath, 'a') as fi:
+            fi.write("more\n")
+        self.assertIsNone(readSnapshot(self.filePath, self.facts))
+
+        self.assertTrue(writeSnapshot(self.filePath, [], self.facts))
+        self.assertEqual(readSnapshot(self.filePath, self.facts), [])
+
+        # Garbage isn't a snapshot.
+        with open(snapshotPath(self.filePath), 'wb') as fi:
+            fi.write(b'INVSNAP')
+        self.assertIsNone(readSnapshot(self.filePath, self.facts))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,639 @@
+#!/usr/bin/python
+
+import attribute
+import collections
+import columns
+import index
+import io
+import itertools
+import mmap
+import os
+import parser
+import re
+import record
+import tempfile
+import unittest
+
+def scanEntries(items, matchRecs):
+    """Returns the sequence numbers of the (seq, (name, Record)) items meeting the
+criteria of any (name, Record) in matchRecs, in the order they came."""
+    compiled = [(name, m.compileMatcher()) for (name, m) in matchRecs]
+    result = []
+    for (seq, (k, rec)) in items:
+        for (name, matches) in compiled:
+            if k == name and matches(rec):
+                result.append(seq)
+                break
+    return result
+
+#
+# RecordStore class:
+# Holds the (name, Record) entries the protocol works on, in insertion order,
+# and keeps indexes over the factory attributes up to date as entries are
+# added, removed or updated. Every attribute gets a hash index for exact
+# criteria, str attributes also get a sorted index for "prefix*" criteria, and
+# int and float attributes a range index for criteria like "<10" or "5..20"
+# (or, columnar, a columns.ColumnIndex, which answers those with array
+# comparisons).
+# Every entry gets a sequence number when it's added; sequence numbers only
+# ever grow, so sorting by them gives back store order. The generation goes
+# up with every change, so anything holding on to a copy knows when it's stale.
+#
+# Criteria no index can answer mean looking at every record. Given a
+# shards.ShardPool, big stores do that in several processes at once.
+#
+class RecordStore:
+    def __init__(self, factories = None, entries = None, columnar = False):
+        """columnar answers range criteria on int and float attributes from
+columns.ColumnIndexes rather than range indexes (which needs numpy)."""
+        if columnar and not columns.available():
+            raise ValueError("The columnar backend needs numpy")
+        self.factories = factories
+        self.entries = {}
+        self.seqs = {}
+        self.nextSeq = 0
+        self.indexes = {}
+        self.generation = 0
+        self.shards = None
+
+        if factories is not None:
+            for (name, fact) in factories.items():
+                for (attrName, attr) in fact.attrs.items():
+                    # The hash index comes first, so it gets exact criteria.
+                    self.addIndex(name, index.HashIndex(attrName, attr.getType()))
+                    if attr.getType() is str:
+                        self.addIndex(name, index.SortedIndex(attrName))
+                    elif columnar and attr.getType() in attribute.rangeTypes:
+                        self.addIndex(name, columns.ColumnIndex(attrName, attr.getType()))
+                    elif attr.getType() in attribute.rangeTypes:
+                        self.addIndex(name, index.RangeIndex(attrName, attr.getType()))
+
+        if entries is not None:
+            self.extend(entries)
+
+    def __iter__(self):
+        "Iterates over a copy of the entries, so the store can change meanwhile."
+        return iter(list(self.entries.values()))
+
+    def iterEntries(self):
+        """Iterates over the entries in store order without copying them first, so
+stopping early (say, after a page of them) only costs what got looked at. The
+store mustn't change until the iteration's done."""
+        return iter(self.entries.values())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iadd__(self, entries):
+        self.extend(entries)
+        return self
+
+    def setShards(self, shardPool):
+        "Scans big enough to be worth it get split up over shardPool (or not, if None)."
+        self.shards = shardPool
+
+    def addIndex(self, name, idx):
+        "Adds idx as an index over records named name, filling it as we go."
+        self.indexes.setdefault(name, {}).setdefault(idx.attrName, []).append(idx)
+        for (seq, (k, rec)) in self.entries.items():
+            if k == name:
+                idx.add(seq, rec)
+
+    def _indexesFor(self, name, attrStr = None):
+        byAttr = self.indexes.get(name, {})
+        if attrStr is not None:
+            return byAttr.get(attrStr, [])
+        return [i for x in byAttr.values() for i in x]
+
+    def add(self, entry):
+        "Appends a (name, Record) entry to the store."
+        (name, rec) = entry
+        self.generation += 1
+        seq = self.nextSeq
+        self.nextSeq += 1
+        self.entries[seq] = entry
+        self.seqs[id(rec)] = seq
+        for idx in self._indexesFor(name):
+            idx.add(seq, rec)
+
+    def extend(self, entries):
+        "Appends all entries, filling the indexes in bulk."
+        self.generation += 1
+        added = {}
+        for entry in entries:
+            (name, rec) = entry
+            seq = self.nextSeq
+            self.nextSeq += 1
+            self.entries[seq] = entry
+            self.seqs[id(rec)] = seq
+            added.setdefault(name, []).append((seq, rec))
+
+        for (name, seqRecs) in added.items():
+            for idx in self._indexesFor(name):
+                idx.addMany(seqRecs)
+
+    def remove(self, entry):
+        "Removes entry from the store. Returns whether it was there."
+        (name, rec) = entry
+        self.generation += 1
+        seq = self.seqs.pop(id(rec), None)
+        if seq is None:
+            return False
+        for idx in self._indexesFor(name):
+            idx.remove(seq, rec)
+        del self.entries[seq]
+        return True
+
+    def removeMany(self, entries):
+        """Removes every entry in entries, dropping them from the indexes in bulk.
+Returns how many of them were there."""
+        self.generation += 1
+        dropped = {}
+        for (name, rec) in entries:
+            seq = self.seqs.pop(id(rec), None)
+            if seq is None:
+                continue
+            del self.entries[seq]
+            dropped.setdefault(name, []).append((seq, rec))
+
+        for (name, seqRecs) in dropped.items():
+            for idx in self._indexesFor(name):
+                idx.removeMany(seqRecs)
+        return sum(len(x) for x in dropped.values())
+
+    def setAttribute(self, entry, attrStr, value):
+        "Record.setAttribute, but keeps the indexes for entry up to date."
+        (name, rec) = entry
+        self.generation += 1
+        seq = self.seqs.get(id(rec))
+        if seq is None:
+            return rec.setAttribute(attrStr, value)
+
+        indexes = self._indexesFor(name, attrStr)
+        for idx in indexes:
+            idx.remove(seq, rec)
+        try:
+            return rec.setAttribute(attrStr, value)
+        finally:
+            for idx in indexes:
+                idx.add(seq, rec)
+
+    def updateMany(self, entries, values):
+        """Sets every (attrStr, value) in values on every entry in entries, keeping
+the indexes up to date in bulk: only the indexes over attributes in values get
+touched, and each gets all of its removes and adds in one go. values should
+already be cast to the attributes' types. Returns how many entries got updated."""
+        self.generation += 1
+        byName = {}
+        for entry in entries:
+            byName.setdefault(entry[0], []).append(entry[1])
+
+        for (name, recs) in byName.items():
+            seqRecs = [(self.seqs[id(r)], r) for r in recs if id(r) in self.seqs]
+            indexes = [idx for (k, _) in values for idx in self._indexesFor(name, k)]
+            for idx in indexes:
+                idx.removeMany(seqRecs)
+            for rec in recs:
+                for (k, v) in values:
+                    rec.setAttribute(k, v)
+            for idx in indexes:
+                idx.addMany(seqRecs)
+        return sum(len(x) for x in byName.values())
+
+    def _candidates(self, name, matchRec):
+        """Returns (the sequence numbers that could match matchRec, whether they're
+sure to: every criteria got answered by an index), or None if no index can
+answer any of its criteria."""
+        found = []
+        exact = True
+        for (k, criteria) in matchRec.items():
+            if criteria is None:
+                continue
+            for idx in self._indexesFor(name, k):
+                if idx.canLookup(criteria):
+                    found.append(idx.lookup(criteria))
+                    break
+            else:
+                exact = False
+
+        if len(found) == 0:
+            return None
+
+        found.sort(key = len)
+        return (found[0].intersection(*found[1:]), exact)
+
+    def match(self, matchRecs):
+        """Returns every entry that meets the criteria of any (name, Record) in
+matchRecs, in store order. Exact criteria are answered from the indexes, and
+"prefix*" criteria from the sorted indexes. Only criteria we have no index for
+(other globs, or prefixes on non-str attributes) fall back to a scan, or to
+checking the records the other criteria picked out."""
+        found = set()
+        scans = []
+        for (name, m) in matchRecs:
+            # Nothing in here can be a record nothing knows how to build.
+            if self.factories is not None and name not in self.factories:
+                continue
+            candidates = self._candidates(name, m)
+            if candidates is None:
+                scans.append((name, m))
+                continue
+            (seqs, exact) = candidates
+            if exact:
+                found.update(seqs)
+                continue
+            matches = m.compileMatcher()
+            for s in seqs:
+                if s not in found and matches(self.entries[s][1]):
+                    found.add(s)
+
+        if len(scans) > 0:
+            if self.shards is not None and self.shards.worthIt(len(self.entries)):
+                found.update(self.shards.scan(self, scans))
+            else:
+                found.update(scanEntries(self.entries.items(), scans))
+        return [self.entries[s] for s in sorted(found)]
+
+_recordPattern = re.compile(rb'\s*\w+:')
+
+#
+# MappedRecordStore class:
+# A RecordStore-alike for big inventory files. It mmaps the file instead of
+# reading it, and uses the byte offset a (backslash-continued) line starts at
+# as that line's sequence number, so opening the file doesn't have to look at
+# any of it. Queries find candidate lines by searching the mapped bytes, and a
+# line only gets parsed into a Record once a query actually needs it. Decoded
+# records live in a bounded LRU cache, except for ones that have been added or
+# changed, which are pinned in memory until they're committed. Added entries
+# are numbered from the end of the file.
+#
+class MappedRecordStore:
+    def __init__(self, factories, filePath, cacheSize = 4096):
+        if factories is None or filePath is None:
+            raise ValueError("Need factories and a file to map")
+        self.factories = factories
+        self.cacheSize = cacheSize
+        self.cache = collections.OrderedDict()
+        self.pinned = {}
+        self.deleted = set()
+        self.seqs = {}
+        self.lastMatched = {}
+        self.lineCount = None
+
+        self.fi = open(filePath, 'rb')
+        self.size = os.fstat(self.fi.fileno()).st_size
+        if self.size > 0:
+            self.mm = mmap.mmap(self.fi.fileno(), 0, access = mmap.ACCESS_READ)
+        else:
+            self.mm = b""
+        self.nextSeq = self.size + 1
+
+        # Searches can't see through a continuation, so lines that have one
+        # always get looked at.
+        self.continued = set()
+        at = self.mm.find(b'\\\n')
+        while at != -1:
+            (start, end) = self._lineAt(at)
+            if self._isRecord(start, end):
+                self.continued.add(start)
+            at = self.mm.find(b'\\\n', end)
+
+    def close(self):
+        if type(self.mm) is mmap.mmap:
+            self.mm.close()
+        self.fi.close()
+
+    def _lineEnd(self, start):
+        "Returns where the line starting at start ends, following continuations."
+        end = self.mm.find(b'\n', start)
+        while end > 0 and self.mm[end - 1] == ord('\\'):
+            end = self.mm.find(b'\n', end + 1)
+        return self.size if end == -1 else end
+
+    def _lineAt(self, pos):
+        "Returns the (start, end) of the line that byte pos is in."
+        start = self.mm.rfind(b'\n', 0, pos) + 1
+        while start > 1 and self.mm[start - 2] == ord('\\'):
+            start = self.mm.rfind(b'\n', 0, start - 1) + 1
+        return (start, self._lineEnd(start))
+
+    def _isRecord(self, start, end):
+        "Returns whether the line from start to end is a record (not blank or a modifier)."
+        if _recordPattern.match(self.mm, start, end) is not None:
+            return True
+        # Names and spaces outside ASCII only match once decoded.
+        return parser.extractRecordName(self.mm[start:end].decode()) is not None
+
+    def _lineStarts(self):
+        "Yields where every record line of the file starts, in order."
+        at = 0
+        while at < self.size:
+            end = self._lineEnd(at)
+            if end > at and self._isRecord(at, end):
+                yield at
+            at = end + 1
+
+    def _findLines(self, needle):
+        "Returns where every record line containing needle starts."
+        result = set()
+        at = self.mm.find(needle)
+        while at != -1:
+            (start, end) = self._lineAt(at)
+            if self._isRecord(start, end):
+                result.add(start)
+            at = self.mm.find(needle, end)
+        return result
+
+    def __iter__(self):
+        for seq in self._lineStarts():
+            entry = self._get(seq)
+            if entry is not None:
+                yield entry
+        for seq in sorted(x for x in self.pinned if x > self.size):
+            yield self.pinned[seq]
+
+    def iterEntries(self):
+        "Same as iterating; the lines only get decoded as they're reached anyway."
+        return iter(self)
+
+    def __len__(self):
+        "How many record lines (and added entries) haven't been deleted."
+        if self.lineCount is None:
+            self.lineCount = sum(1 for _ in self._lineStarts())
+        return self.lineCount + self.nextSeq - (self.size + 1) - len(self.deleted)
+
+    def __iadd__(self, entries):
+        self.extend(entries)
+        return self
+
+    def _decode(self, seq):
+        raw = self.mm[seq:self._lineEnd(seq)].decode()
+        for i in parser.parseStream(io.StringIO(raw), self.factories):
+            return i
+        return None
+
+    def _get(self, seq):
+        "Returns the entry for seq, decoding it if it isn't in memory."
+        if seq in self.deleted:
+            return None
+        entry = self.pinned.get(seq)
+        if entry is not None:
+            return entry
+        entry = self.cache.get(seq)
+        if entry is not None:
+            self.cache.move_to_end(seq)
+            return entry
+
+        entry = self._decode(seq)
+        self.cache[seq] = entry
+        self.seqs[id(entry[1])] = seq
+        if len(self.cache) > self.cacheSize:
+            (_, (_, oldRec)) = self.cache.popitem(last = False)
+            del self.seqs[id(oldRec)]
+        return entry
+
+    def _seqOf(self, entry):
+        seq = self.seqs.get(id(entry[1]))
+        if seq is None and id(entry[1]) in self.lastMatched:
+            seq = self.lastMatched[id(entry[1])][0]
+        return seq
+
+    def _pin(self, seq, entry):
+        self.cache.pop(seq, None)
+        self.pinned[seq] = entry
+        self.seqs[id(entry[1])] = seq
+
+    def add(self, entry):
+        seq = self.nextSeq
+        self.nextSeq += 1
+        self._pin(seq, entry)
+
+    def extend(self, entries):
+        for i in entries:
+            self.add(i)
+
+    def removeMany(self, entries):
+        return sum(1 for x in entries if self.remove(x))
+
+    def remove(self, entry):
+        seq = self._seqOf(entry)
+        if seq is None or seq in self.deleted:
+            return False
+        self.deleted.add(seq)
+        self.cache.pop(seq, None)
+        self.pinned.pop(seq, None)
+        self.seqs.pop(id(entry[1]), None)
+        return True
+
+    def setAttribute(self, entry, attrStr, value):
+        seq = self._seqOf(entry)
+        if seq is not None and seq not in self.deleted:
+            self._pin(seq, entry)
+        return entry[1].setAttribute(attrStr, value)
+
+    def updateMany(self, entries, values):
+        count = 0
+        for entry in entries:
+            for (k, v) in values:
+                self.setAttribute(entry, k, v)
+            count += 1
+        return count
+
+    def _needles(self, name, matchRec):
+        """Returns byte strings that any line matching matchRec has to contain.
+A str attribute equal to (or starting with) v always shows up as "v in the
+line, so lines without that never need decoding."""
+        slots = self.factories[name].getSchema().slots
+        result = []
+        for (k, v) in matchRec.items():
+            if v is None or k not in slots or slots[k][1] is not str:
+                continue
+            if not attribute.isBasicRegex(v):
+                result.append(('"' + v + '"').encode())
+            elif attribute.getPrefix(v) is not None:
+                result.append(('"' + attribute.getPrefix(v)).encode())
+        return result
+
+    def _mightMatch(self, seq, needles):
+        if seq in self.continued:
+            return True
+        raw = self.mm[seq:self._lineEnd(seq)]
+        for i in needles:
+            if i not in raw:
+                return False
+        return True
+
+    def match(self, matchRecs):
+        """Returns every entry that meets the criteria of any (name, Record) in
+matchRecs, in file order. Lines whose bytes can't match are never decoded."""
+        found = {}
+        for (name, m) in matchRecs:
+            if name not in self.factories:
+                continue
+            needles = self._needles(name, m)
+            if len(needles) > 0:
+                needles.sort(key = len)
+                seqs = self._findLines(needles[-1]) | self.continued
+                seqs = [x for x in sorted(seqs) if self._mightMatch(x, needles)]
+            else:
+                seqs = self._lineStarts()
+
+            matches = m.compileMatcher()
+            # Changed entries might not match what's in the file any more.
+            for seq in itertools.chain(seqs, self.pinned.keys()):
+                if seq in found:
+                    continue
+                entry = self._get(seq)
+                if entry is not None and entry[0] == name and matches(entry[1]):
+                    found[seq] = entry
+
+        self.lastMatched = dict((id(e[1]), (seq, e)) for (seq, e) in found.items())
+        return [found[seq] for seq in sorted(found)]
+
+class StoreTests(unittest.TestCase):
+    @staticmethod
+    def genStore():
+        fact = record.RecordFactory()
+        at = attribute.Attribute()
+        fact.addAttribute("id", at)
+        at = attribute.Attribute()
+        at.setType(int)
+        fact.addAttribute("quantity", at)
+
+        factories = {"Part": fact}
+        entries = []
+        for (i, q) in [("10", 1), ("11", 2), ("12", 2), ("20", 3)]:
+            entries.append(("Part", fact.generateRecord([("id", i), ("quantity", q)])))
+        return (factories, RecordStore(factories, entries))
+
+    @staticmethod
+    def genMatch(factories, *kv):
+        return [("Part", factories["Part"].generateMatchRecord(kv))]
+
+    def ids(self, entries):
+        return [r.getAttribute("id") for (_, r) in entries]
+
+    def test_match(self):
+        (facts, st) = StoreTests.genStore()
+        self.assertEqual(len(st), 4)
+        self.assertEqual(self.ids(st), ["10", "11", "12", "20"])
+
+        m = StoreTests.genMatch
+        self.assertEqual(self.ids(st.match(m(facts, ("id", "11")))), ["11"])
+        self.assertEqual(self.ids(st.match(m(facts, ("quantity", "2")))), ["11", "12"])
+        self.assertEqual(self.ids(st.match(m(facts, ("quantity", "2"), ("id", "12")))), ["12"])
+        self.assertEqual(self.ids(st.match(m(facts, ("id", "1*")))), ["10", "11", "12"])
+        self.assertEqual(self.ids(st.match(m(facts, ("id", "*0")))), ["10", "20"])
+        self.assertEqual(self.ids(st.match(m(facts, ("id", "1*"), ("quantity", "2*")))), ["11", "12"])
+        self.assertEqual(self.ids(st.match(m(facts, ("quantity", "lol")))), [])
+        self.assertEqual(self.ids(st.match(m(facts, ("id", "99")))), [])
+
+        # Different matchers are an OR, and entries only come back once.
+        either = m(facts, ("id", "20")) + m(facts, ("quantity", "2")) + m(facts, ("id", "11"))
+        self.assertEqual(self.ids(st.match(either)), ["11", "12", "20"])
+
+    def test_mutate(self):
+        (facts, st) = StoreTests.genStore()
+        m = StoreTests.genMatch
+
+        (e,) = st.match(m(facts, ("id", "11")))
+        self.assertTrue(st.remove(e))
+        self.assertFalse(st.remove(e))
+        self.assertEqual(self.ids(st.match(m(facts, ("quantity", "2")))), ["12"])
+
+        (e,) = st.match(m(facts, ("id", "12")))
+        self.assertTrue(st.setAttribute(e, "quantity", "7"))
+        self.assertEqual(self.ids(st.match(m(facts, ("quantity", "2")))), [])
+        self.assertEqual(self.ids(st.match(m(facts, ("quantity", "7")))), ["12"])
+        self.assertFalse(st.setAttribute(e, "quantity", "lol"))
+        self.assertEqual(self.ids(st.match(m(facts, ("quantity", "7")))), [])
+
+        st += [("Part", facts["Part"].generateRecord([("id", "11"), ("quantity", "7")]))]
+        self.assertEqual(self.ids(st), ["10", "12", "20", "11"])
+        self.assertEqual(self.ids(st.match(m(facts, ("id", "11")))), ["11"])
+        self.assertEqual(self.ids(st.match(m(facts, ("id", "1*")))), ["10", "12", "11"])
+
+        self.assertEqual(self.ids(st.match(m(facts, ("quantity", "<7")))), ["10", "20"])
+        self.assertEqual(self.ids(st.match(m(facts, ("quantity", "1..7"), ("id", "1*")))),
+                         ["10", "11"])
+
+        (e,) = st.match(m(facts, ("id", "20")))
+        self.assertTrue(st.setAttribute(e, "id", "13"))
+        self.assertEqual(self.ids(st.match(m(facts, ("id", "2*")))), [])
+        self.assertEqual(self.ids(st.match(m(facts, ("id", "1*")))), ["10", "12", "13", "11"])
+
+        entries = st.iterEntries()
+        self.assertEqual(next(entries), list(st)[0])
+        self.assertEqual([next(entries)] + list(entries), list(st)[1:])
+
+        self.assertEqual(st.updateMany(st.match(m(facts, ("quantity", "<=7"))),
+                                       [("quantity", 9)]), 3)
+        self.assertEqual(self.ids(st.match(m(facts, ("quantity", "9")))), ["10", "13", "11"])
+        self.assertEqual(self.ids(st.match(m(facts, ("quantity", "<9")))), [])
+        self.assertEqual(self.ids(st.match(m(facts, ("id", "1*")))), ["10", "12", "13", "11"])
+
+        self.assertEqual(st.removeMany(st.match(m(facts, ("id", "1*"))) + [e]), 4)
+        self.assertEqual(len(st), 0)
+        self.assertEqual(st.removeMany([e]), 0)
+        self.assertEqual(self.ids(st.match(m(facts, ("quantity", "7")))), [])
+
+    @unittest.skipUnless(columns.available(), "needs numpy")
+    def test_columnar(self):
+        (facts, st) = StoreTests.genStore()
+        cst = RecordStore(facts, list(st), columnar = True)
+        self.assertEqual([type(x) for x in cst._indexesFor("Part", "quantity")],
+                         [index.HashIndex, columns.ColumnIndex])
+        m = StoreTests.genMatch
+        for criteria in [("quantity", "2"), ("quantity", "2*"), ("id", "1*"),
+                         ("quantity", "<3"), ("quantity", "2..3"), ("quantity", ">1")]:
+            self.assertEqual(cst.match(m(facts, criteria)), st.match(m(facts, criteria)))
+
+        (e,) = cst.match(m(facts, ("id", "12")))
+        cst.setAttribute(e, "quantity", "7")
+        self.assertEqual(self.ids(cst.match(m(facts, ("quantity", "2")))), ["11"])
+        self.assertEqual(self.ids(cst.match(m(facts, ("quantity", "7")))), ["12"])
+        self.assertEqual(self.ids(cst.match(m(facts, ("quantity", ">2")))), ["12", "20"])
+
+    def test_mapped(self):
+        (facts, st) = StoreTests.genStore()
+        with tempfile.NamedTemporaryFile('w', suffix = '.parts', delete = False) as fi:
+            fi.write('\n'.join("Part: " + str(r) for (_, r) in st))
+            fi.write('\n\nPart: id="30" \\\n quantity="9"\n')
+            # Neither of these is an entry, even where a search finds them.
+            fi.write('  \t \nnote = id="11" \\\n quantity="9"\n')
+        try:
+            mst = MappedRecordStore(facts, fi.name, cacheSize = 2)
+            m = StoreTests.genMatch
+            self.assertEqual(len(mst), 5)
+            self.assertEqual(len(mst.cache), 0)
+            self.assertEqual(self.ids(mst.match(m(facts, ("id", "11")))), ["11"])
+            # Only 11 and the continued line (which we can't search) got decoded.
+            self.assertEqual(len(mst.cache), 2)
+            self.assertEqual(len(mst.continued), 1)
+            self.assertEqual(self.ids(mst.match(m(facts, ("id", "1*"), ("quantity", "2")))), ["11", "12"])
+            self.assertEqual(self.ids(mst.match(m(facts, ("quantity", "9")))), ["30"])
+            self.assertEqual(self.ids(mst.match(m(facts, ("id", "*0")))), ["10", "20", "30"])
+            self.assertLessEqual(len(mst.cache), 2)
+            self.assertEqual(len(mst), 5)
+            self.assertEqual(self.ids(mst), ["10", "11", "12", "20", "30"])
+
+            # Changes survive the cache evicting things.
+            (e1, e2) = mst.match(m(facts, ("quantity", "2")))
+            self.assertTrue(mst.remove(e1))
+            self.assertFalse(mst.remove(e1))
+            self.assertTrue(mst.setAttribute(e2, "quantity", "7"))
+            mst += [("Part", facts["Part"].generateRecord([("id", "40"), ("quantity", "7")]))]
+            self.assertEqual(self.ids(mst.match(m(facts, ("id", "*")))), ["10", "12", "20", "30", "40"])
+            self.assertEqual(self.ids(mst.match(m(facts, ("quantity", "7")))), ["12", "40"])
+            self.assertEqual(self.ids(mst), ["10", "12", "20", "30", "40"])
+            self.assertEqual(self.ids(mst.iterEntries()), self.ids(mst))
+            self.assertEqual(len(mst), 5)
+            self.assertEqual(mst.updateMany(mst.match(m(facts, ("quantity", "7"))),
+                                            [("quantity", 8)]), 2)
+            self.assertEqual(self.ids(mst.match(m(facts, ("quantity", "8")))), ["12", "40"])
+            mst.close()
+        finally:
+            os.unlink(fi.name)
+
+if __name__ == '__main__':
+    unittest.main()